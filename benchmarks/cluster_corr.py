@@ -0,0 +1,53 @@
+"""benchmarks cluster_corr on large correlation matrices
+
+run using:
+
+python benchmarks/cluster_corr.py
+
+prints the time each method takes for N = 1k, 10k and 50k
+variables. Methods that would take too long (or need too much
+memory) for some N are skipped. The 50k matrix alone needs 10 GB
+(in float32).
+"""
+
+import time
+
+import numpy as np
+
+from pycore.maths import cluster_corr
+
+# largest N to try each method on
+MAX_N = dict(exact=5_000, blockwise=20_000, sample=50_000)
+
+
+def make_corr(n: int, n_groups: int = 20, seed: int = 0) -> np.ndarray:
+    """makes a float32 correlation matrix with some block structure"""
+
+    rng = np.random.default_rng(seed)
+    groups = rng.integers(0, n_groups, n)
+    loadings = np.zeros((n, n_groups), dtype=np.float32)
+    loadings[np.arange(n), groups] = 1
+    loadings += 0.3 * rng.standard_normal((n, n_groups)).astype(np.float32)
+    loadings /= np.linalg.norm(loadings, axis=1, keepdims=True)
+
+    return loadings @ loadings.T
+
+
+def main() -> None:
+    """runs all methods on all sizes"""
+
+    print(f"{'N':>8}{'method':>12}{'seconds':>10}")
+    for n in [1_000, 10_000, 50_000]:
+        corr = make_corr(n)
+        for method, max_n in MAX_N.items():
+            if n > max_n:
+                continue
+            tic = time.perf_counter()
+            cluster_corr(corr, method=method, inplace=True)
+            seconds = time.perf_counter() - tic
+            print(f"{n:>8}{method:>12}{seconds:>10.2f}")
+        del corr
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""benchmarks the hash backends used by md5hash
+
+run using:
+
+python benchmarks/hash_backends.py
+
+prints throughput (in bytes per second) of every available
+backend on a large array, a large DataFrame and a nested list
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from pycore.core import hash_backends, md5hash
+from pycore.filetools import format_bytes
+
+
+def make_payloads() -> dict:
+    """makes things to hash, and reports how many bytes each has"""
+
+    rng = np.random.default_rng(0)
+
+    array = rng.random(2**24)
+
+    df = pd.DataFrame(
+        dict(
+            a=rng.random(2**20),
+            b=rng.integers(0, 100, 2**20),
+            c=rng.random(2**20),
+        )
+    )
+
+    nested = [[float(x), str(x)] for x in rng.random(2**16)]
+    nested_bytes = sum(8 + len(thing[1]) for thing in nested)
+
+    return dict(
+        array=(array, array.nbytes),
+        dataframe=(df, int(df.memory_usage(index=True).sum())),
+        nested_list=(nested, nested_bytes),
+    )
+
+
+def time_backend(obj, backend: str, repeats: int = 3) -> float:
+    """best wall-clock time (in seconds) to hash obj"""
+
+    best = np.inf
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        md5hash(obj, backend=backend)
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main() -> None:
+    """runs all backends on all payloads"""
+
+    payloads = make_payloads()
+
+    print(f"{'payload':<14}{'backend':<10}{'throughput':>16}")
+    for payload_name, (obj, n_bytes) in payloads.items():
+        for backend in hash_backends():
+            t = time_backend(obj, backend)
+            rate = format_bytes(int(n_bytes / t)) + "/s"
+            print(f"{payload_name:<14}{backend:<10}{rate:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""benchmarks nonzero_bounds against a mask of the whole array
+
+run using:
+
+python benchmarks/nonzero_bounds.py
+
+prints the time nonzero_bounds and (arr != 0).argmax take along
+each axis of arrays with few long lanes, and with many short ones
+(where reading a block of every lane at once doesn't fit the budget)
+"""
+
+import time
+
+import numpy as np
+
+from pycore.matlab import nonzero_bounds
+
+SHAPES = [(100, 2_000_000), (2_000_000, 100), (300_000, 50)]
+
+
+def make_array(shape: tuple) -> np.ndarray:
+    """zeros, with a nonzero line through the middle of each axis"""
+
+    arr = np.zeros(shape, dtype=np.float32)
+    arr[shape[0] // 2, :] = 1
+    arr[:, shape[1] // 2] = 1
+    return arr
+
+
+def best_time(func, repeats: int = 3) -> float:
+    """best wall-clock time (in seconds) to run func"""
+
+    best = np.inf
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main() -> None:
+    """times both methods on every shape and axis"""
+
+    print(f"{'shape':<18}{'axis':<6}{'nonzero_bounds':>16}{'mask':>10}")
+    for shape in SHAPES:
+        arr = make_array(shape)
+        for axis in range(arr.ndim):
+            scan = best_time(lambda: nonzero_bounds(arr, axis=axis))
+            mask = best_time(lambda: (arr != 0).argmax(axis=axis))
+            print(f"{str(shape):<18}{axis:<6}{scan:>15.3f}s{mask:>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,36 @@
 """
 pycore
+
+submodules are imported the first time they are used (e.g.
+pycore.maths.cluster_corr), so that "import pycore" is instant, and
+scripts that only need pycore.core never load matplotlib, bokeh,
+scipy or pandas
 """
+
+import importlib
+
+_SUBMODULES = (
+    "bokeh_downsample",
+    "bokeh_statusbar",
+    "core",
+    "dev",
+    "filetools",
+    "graphics",
+    "jupyter_utils",
+    "maths",
+    "matlab",
+    "memoize",
+    "parallel",
+    "validate",
+)
+
+
+def __getattr__(name: str):
+    """imports submodules on first use"""
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES))
@@ -0,0 +1,113 @@
+"""server-side downsampling of long traces in bokeh figures.
+
+Instead of putting millions of points in a ColumnDataSource, the
+trace is summarized once in a MinMaxPyramid, and the source only ever
+holds n_points min/max points of the part of the trace that is
+visible. When the x range changes, the visible window is resampled
+and sent to the browser as a patch of the (fixed length) columns.
+
+Range changes are debounced, so that panning or zooming only
+triggers one update once the range stops changing.
+
+This needs a bokeh server (e.g. bokeh serve, or a notebook with
+a server app), because updates run in python.
+"""
+
+from typing import Optional
+
+import numpy as np
+from bokeh.models import ColumnDataSource
+
+from pycore.graphics import MinMaxPyramid
+
+
+def attach(
+    fig,
+    trace: np.ndarray,
+    *,
+    n_points: int = 2000,
+    delay: int = 100,
+    x0: float = 0.0,
+    dx: float = 1.0,
+    pyramid: Optional[MinMaxPyramid] = None,
+    **line_options,
+) -> ColumnDataSource:
+    """plots a downsampled trace as a line in fig, and keeps it
+    resampled to the visible x range
+
+    Args:
+        fig: bokeh figure
+        trace (np.ndarray): 1-D trace, or np.memmap
+        n_points (int): number of points sent to the browser
+        delay (int): milliseconds to wait for the range to stop
+        changing before resampling
+        x0 (float): x of the first sample
+        dx (float): x distance between samples
+        pyramid (MinMaxPyramid, optional): precomputed pyramid of trace
+        **line_options: passed on to fig.line
+
+    Returns:
+        ColumnDataSource with columns x and y, of length n_points
+    """
+
+    if pyramid is None:
+        pyramid = MinMaxPyramid(trace)
+
+    x, y = _window(pyramid, 0, len(trace), n_points=n_points, x0=x0, dx=dx)
+    source = ColumnDataSource(data=dict(x=x, y=y))
+    fig.line("x", "y", source=source, **line_options)
+
+    pending = []
+
+    def update():
+        pending.clear()
+        start, end = fig.x_range.start, fig.x_range.end
+        if start is None or end is None:
+            return
+
+        first = int(np.floor((start - x0) / dx))
+        last = int(np.ceil((end - x0) / dx)) + 1
+        x, y = _window(pyramid, first, last, n_points=n_points, x0=x0, dx=dx)
+        source.patch(
+            dict(x=[(slice(0, n_points), x)], y=[(slice(0, n_points), y)])
+        )
+
+    def schedule(attr, old, new):
+        document = fig.document
+        if document is None:
+            return
+
+        # restart the wait, so only the last change triggers an update
+        for callback in pending:
+            try:
+                document.remove_timeout_callback(callback)
+            except ValueError:
+                # already ran
+                pass
+        pending[:] = [document.add_timeout_callback(update, delay)]
+
+    fig.x_range.on_change("start", schedule)
+    fig.x_range.on_change("end", schedule)
+
+    return source
+
+
+def _window(
+    pyramid: MinMaxPyramid,
+    start: int,
+    stop: int,
+    *,
+    n_points: int,
+    x0: float,
+    dx: float,
+) -> tuple:
+    """at most n_points of samples [start, stop), padded with NaN to
+    exactly n_points, so that columns never change length"""
+
+    index, values = pyramid.query(start, stop, n_points=n_points)
+
+    x = np.full(n_points, np.nan)
+    y = np.full(n_points, np.nan)
+    x[: len(index)] = x0 + dx * index
+    y[: len(values)] = values
+    return x, y
@@ -5,10 +5,12 @@ and types
 """
 
 import hashlib
-from typing import Optional
+import os
+import sys
+import weakref
+from typing import Callable, Optional
 
 import numpy as np
-import pandas as pd
 
 from beartype import beartype
 
@@ -41,8 +43,118 @@ def format_p_value(pvalue: float) -> str:
         return "p = " + "{:.3f}".format(pvalue)
 
 
+# arrays are fed to the hasher in pieces of (at most) this many bytes
+# when they can't be handed over as a single buffer
+_HASH_CHUNK_BYTES = 1 << 22
+
+# name of the environment variable that picks the default hash backend
+HASH_BACKEND_ENV_VAR = "PYCORE_HASH_BACKEND"
+
+
+def _xxh3():
+    """makes a 128-bit xxh3 hasher. xxhash is an optional dependency"""
+    try:
+        import xxhash
+    except ImportError:
+        raise ImportError(
+            "the xxh3 hash backend needs xxhash. Install it "
+            "using 'pip install xxhash'"
+        ) from None
+    return xxhash.xxh3_128()
+
+
+# maps backend names to functions that make new hashlib-like objects
+_HASH_BACKENDS = {
+    "md5": hashlib.md5,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+    "xxh3": _xxh3,
+}
+
+
+@beartype
+def register_hash_backend(name: str, factory: Callable) -> None:
+    """
+    registers a new backend that md5hash and hash_dict can use
+
+    Args:
+        name (str): name of the backend. Digests made with this
+        backend are prefixed with "name:"
+        factory (Callable): called with no arguments, returns a new
+        object with hashlib's update(), digest() and hexdigest()
+        methods
+    """
+
+    assert ":" not in name, "Backend names can't contain ':'"
+    _HASH_BACKENDS[name] = factory
+
+
+def hash_backends() -> list:
+    """
+    lists hash backends that can be used in this environment
+
+    Returns:
+        list: names of usable backends, e.g. ["md5", "blake2b"]
+    """
+
+    available = []
+    for name, factory in _HASH_BACKENDS.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def resolve_hash_backend(backend: Optional[str] = None) -> str:
+    """
+    picks a hash backend: the argument if given, otherwise the
+    PYCORE_HASH_BACKEND environment variable, otherwise md5
+
+    Args:
+        backend (str, optional): name of a hash backend
+
+    Returns:
+        str: name of the backend that md5hash(..., backend=backend)
+        would use
+    """
+
+    if backend is None:
+        backend = os.environ.get(HASH_BACKEND_ENV_VAR, "md5")
+
+    if backend not in _HASH_BACKENDS:
+        raise ValueError(
+            f"Unknown hash backend: {backend}. "
+            f"Known backends are: {list(_HASH_BACKENDS)}"
+        )
+    return backend
+
+
+def _new_hasher(backend: str):
+    """makes a new hasher using a (resolved) backend name"""
+    return _HASH_BACKENDS[backend]()
+
+
+def _format_digest(backend: str, m) -> str:
+    """formats the digest of hasher m
+
+    md5 digests are bare hex strings, so that they match what
+    older versions of pycore made. Every other backend prefixes
+    its name, so that digests from different backends never collide
+    """
+
+    if backend == "md5":
+        return m.hexdigest()
+    return f"{backend}:{m.hexdigest()}"
+
+
 @beartype
-def md5hash(obj) -> str:
+def md5hash(
+    obj,
+    *,
+    legacy: bool = False,
+    backend: Optional[str] = None,
+) -> str:
     """
     hash almost anything
 
@@ -51,14 +163,228 @@ def md5hash(obj) -> str:
 
     Objects supported are:
 
-    - float
-    - list
-    - np.array
-    - str
-    - pd.DataFrame
-    - tuple
+    - None
+    - bool, int, float
+    - str, bytes
+    - list, tuple (hashed recursively)
+    - np.array (including non-contiguous views)
+    - pd.DataFrame, pd.Series
+
+    Everything is streamed into a single hasher, so no intermediate
+    strings or copies of large buffers are made: contiguous arrays
+    are handed over as zero-copy buffers, non-contiguous arrays are
+    copied one small chunk at a time, and DataFrames are hashed as a
+    single buffer of row hashes.
+
+    Despite the name, the hash function itself is pluggable. md5 is
+    used by default, but faster backends (e.g. "blake2b", or "xxh3"
+    if xxhash is installed) can be picked using the backend argument
+    or the PYCORE_HASH_BACKEND environment variable. See
+    hash_backends() and register_hash_backend().
+
+    Args:
+        obj: object to hash
+        legacy (bool, optional): reproduce the digests of older
+        versions of this function. This is much slower on
+        large objects, only works with md5, and only exists so that
+        old hashes can be regenerated
+        backend (str, optional): name of the hash backend to use
+
+    Returns:
+        str: hex-encoded digest. Digests from backends other than
+        md5 are prefixed with the name of the backend, e.g.
+        "blake2b:..."
+    """
+
+    if legacy:
+        _check_legacy_backend(backend)
+        return _md5hash_legacy(obj)
+
+    backend = resolve_hash_backend(backend)
+    m = _new_hasher(backend)
+    _stream_update(m, obj)
+    return _format_digest(backend, m)
 
+
+@beartype
+def hash_file(
+    path: str,
+    *,
+    backend: Optional[str] = None,
+    partial_bytes: Optional[int] = None,
+) -> str:
     """
+    hash the contents of a file
+
+    the file is read in pieces, so files of any size can be hashed.
+    Note that this hashes the bytes in the file, so the digest is not
+    the same as md5hash of the same bytes
+
+    Args:
+        path (str): path to the file
+        backend (str, optional): name of the hash backend to use, see
+        md5hash
+        partial_bytes (int, optional): only hash the first and the
+        last partial_bytes of the file
+
+    Returns:
+        str: hex-encoded digest, prefixed like those of md5hash
+    """
+
+    backend = resolve_hash_backend(backend)
+    m = _new_hasher(backend)
+    with open(path, "rb") as file:
+        if partial_bytes is None:
+            while True:
+                chunk = file.read(_HASH_CHUNK_BYTES)
+                if not chunk:
+                    break
+                m.update(chunk)
+        else:
+            m.update(file.read(partial_bytes))
+            size = os.fstat(file.fileno()).st_size
+            if size > partial_bytes:
+                file.seek(max(partial_bytes, size - partial_bytes))
+                m.update(file.read(partial_bytes))
+    return _format_digest(backend, m)
+
+
+def _check_legacy_backend(backend: Optional[str]) -> None:
+    """legacy digests were always made with md5"""
+    if backend is not None and backend != "md5":
+        raise ValueError("legacy hashes can only be made using md5")
+
+
+def is_pandas(obj, *, series: bool = True) -> bool:
+    """
+    checks if obj is a DataFrame (or Series), without importing
+    pandas: if pandas was never imported, obj can't be either
+
+    Args:
+        obj: object to check
+        series (bool, optional): also accept Series
+
+    Returns:
+        bool: True if obj is a DataFrame (or a Series)
+    """
+
+    pd = sys.modules.get("pandas")
+    if pd is None:
+        return False
+    if series:
+        return isinstance(obj, (pd.DataFrame, pd.Series))
+    return isinstance(obj, pd.DataFrame)
+
+
+def _stream_update(m, obj) -> None:
+    """feeds obj into the hasher m
+
+    every object is preceded by a type tag and (where relevant) its
+    length, so that different objects that share a byte representation
+    (e.g. ["ab"] and ["a", "b"]) don't collide
+    """
+
+    if obj is None:
+        m.update(b"N")
+
+    elif isinstance(obj, bool):
+        m.update(b"?1" if obj else b"?0")
+
+    elif isinstance(obj, int):
+        n_bytes = obj.bit_length() // 8 + 1
+        m.update(b"i" + n_bytes.to_bytes(8, "little"))
+        m.update(obj.to_bytes(n_bytes, "little", signed=True))
+
+    elif isinstance(obj, float):
+        m.update(b"f")
+        m.update(np.float64(obj).tobytes())
+
+    elif isinstance(obj, str):
+        _update_bytes(m, b"s", obj.encode())
+
+    elif isinstance(obj, (bytes, bytearray)):
+        _update_bytes(m, b"b", obj)
+
+    elif isinstance(obj, (list, tuple)):
+        m.update(b"l" + len(obj).to_bytes(8, "little"))
+        for thing in obj:
+            _stream_update(m, thing)
+
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        _update_array(m, np.asarray(obj))
+
+    elif is_pandas(obj):
+        pd = sys.modules["pandas"]
+        # row hashes cover values and the index, but not column
+        # labels or dtypes, so those go in first
+        if isinstance(obj, pd.DataFrame):
+            m.update(b"p")
+            _stream_update(m, [repr(column) for column in obj.columns])
+            _stream_update(m, [str(dtype) for dtype in obj.dtypes])
+        else:
+            m.update(b"r")
+            _stream_update(m, [repr(obj.name), str(obj.dtype)])
+        _update_array(m, pd.util.hash_pandas_object(obj).to_numpy())
+
+    else:
+        raise TypeError(f"md5hash can't hash objects of type {type(obj)}")
+
+
+def _update_bytes(m, tag: bytes, data) -> None:
+    """feeds a length-prefixed byte string into hasher m"""
+    m.update(tag + len(data).to_bytes(8, "little"))
+    m.update(data)
+
+
+def _update_array(m, arr: np.ndarray) -> None:
+    """feeds a numpy array into hasher m
+
+    the header (dtype and shape) is hashed first, followed by the
+    data in C order. C-contiguous arrays are passed as a single
+    zero-copy buffer; anything else is walked along the first axis
+    in blocks of at most _HASH_CHUNK_BYTES, so at most one block
+    is ever copied
+    """
+
+    header = f"{arr.dtype.str}{arr.shape}".encode()
+    _update_bytes(m, b"a", header)
+
+    if arr.dtype.hasobject:
+        for thing in arr.flat:
+            _stream_update(m, thing)
+        return
+
+    if arr.size == 0:
+        return
+
+    _update_array_data(m, arr)
+
+
+def _update_array_data(m, arr: np.ndarray) -> None:
+    """feeds the data (but not the header) of an array into m, in
+    C order, copying at most _HASH_CHUNK_BYTES at a time"""
+
+    if arr.flags.c_contiguous:
+        # zero-copy view of the underlying buffer
+        m.update(arr.reshape(-1).view(np.uint8))
+        return
+
+    row_bytes = arr[0].nbytes
+    rows_per_chunk = max(1, _HASH_CHUNK_BYTES // max(row_bytes, 1))
+
+    for start in range(0, arr.shape[0], rows_per_chunk):
+        chunk = arr[start : start + rows_per_chunk]
+        if chunk.ndim > 1 and row_bytes > _HASH_CHUNK_BYTES:
+            # a single row is too big to copy, so go one level deeper
+            for row in chunk:
+                _update_array_data(m, row)
+        else:
+            m.update(np.ascontiguousarray(chunk).reshape(-1).view(np.uint8))
+
+
+def _md5hash_legacy(obj) -> str:
+    """the original implementation of md5hash, kept so that
+    digests generated by older versions can be reproduced"""
 
     m = hashlib.md5()
 
@@ -75,14 +401,15 @@ def md5hash(obj) -> str:
         t = tuple(obj)
         list_m = ""
         for thing in t:
-            list_m += md5hash(thing)
+            list_m += _md5hash_legacy(thing)
         m.update(list_m.encode())
     elif isinstance(obj, np.ndarray):
         m.update(np.ascontiguousarray(obj))
     elif isinstance(obj, str):
         m.update(obj.encode())
-    elif isinstance(obj, pd.DataFrame):
-        pd_hash = md5hash(list(pd.util.hash_pandas_object(obj)))
+    elif is_pandas(obj, series=False):
+        pd = sys.modules["pandas"]
+        pd_hash = _md5hash_legacy(list(pd.util.hash_pandas_object(obj)))
         m.update(pd_hash.encode())
     else:
         m.update(obj.to_bytes(8, "big"))
@@ -94,34 +421,162 @@ def hash_dict(
     dictionary: dict,
     *,
     ignore_keys: Optional[list] = None,
+    legacy: bool = False,
+    backend: Optional[str] = None,
+    cache: bool = False,
 ) -> str:
     """
-    hashes a dictionary, by directly hashing values
-    numpy.ndarrays are converted to bytes and then hashed
-    all hashes are combined to return a single hash
+    hashes a dictionary, by hashing its keys and values
+    each value is hashed with md5hash, and the (key, hash)
+    pairs are combined to return a single hash
+
+    If cache is True, hashes of immutable values are remembered,
+    so hashing the same (large) value again is O(1). Only read-only
+    numpy arrays (arr.flags.writeable = False, with no writeable
+    base array) are cached, and they are only held by weak
+    references, so memory is freed as soon as they are garbage
+    collected. Use hash_cache_stats() to see if the cache is helping.
 
     Args:
         dictionary (dict): some dictionary with string keys
+        ignore_keys (list, optional): keys to leave out of the hash
+        legacy (bool, optional): reproduce the digests of older
+        versions of this function, which ignored keys
+        backend (str, optional): name of the hash backend to use,
+        see md5hash
+        cache (bool, optional): reuse hashes of immutable values
 
     Returns:
         hash: hex-encoded string
     """
 
     keys = list(dictionary.keys())
-    hashes = []
 
     # sort keys to make this reproducible
     keys.sort()
 
+    if ignore_keys is not None:
+        keys = [key for key in keys if key not in ignore_keys]
+
+    if legacy:
+        _check_legacy_backend(backend)
+        return _md5hash_legacy(
+            [_md5hash_legacy(dictionary[key]) for key in keys]
+        )
+
+    backend = resolve_hash_backend(backend)
+
+    m = _new_hasher(backend)
+    m.update(b"d" + len(keys).to_bytes(8, "little"))
     for key in keys:
-        if ignore_keys is not None and key in ignore_keys:
-            continue
+        _stream_update(m, key)
+        if cache:
+            m.update(_cached_digest_value(dictionary[key], backend))
+        else:
+            m.update(_digest_value(dictionary[key], backend))
+
+    return _format_digest(backend, m)
+
+
+def _digest_value(value, backend: str) -> bytes:
+    """raw digest of a single value, using some backend"""
+    m = _new_hasher(backend)
+    _stream_update(m, value)
+    return m.digest()
+
+
+# maps id(obj) -> (weak reference to obj, fingerprint, {backend: digest})
+_HASH_CACHE = {}
+_HASH_CACHE_STATS = dict(hits=0, misses=0, uncacheable=0)
+
+
+def _is_immutable(arr: np.ndarray) -> bool:
+    """an array is treated as immutable if neither it nor any of the
+    arrays it is a view of are writeable, and its memory ultimately
+    belongs to itself or to a bytes object"""
+
+    while isinstance(arr, np.ndarray):
+        if arr.flags.writeable:
+            return False
+        arr = arr.base
+    return arr is None or isinstance(arr, bytes)
+
+
+def _fingerprint(value):
+    """cheap summary of a value that changes if the value is
+    reallocated or reshaped. None means the value can't be cached"""
+
+    if type(value) is np.ndarray and _is_immutable(value):
+        return (
+            value.shape,
+            value.dtype.str,
+            value.strides,
+            value.flags.writeable,
+            value.__array_interface__["data"][0],
+        )
+    return None
+
+
+def _forget(key: int, ref) -> None:
+    """called when a cached value is garbage collected"""
+    entry = _HASH_CACHE.get(key)
+    if entry is not None and entry[0] is ref:
+        del _HASH_CACHE[key]
+
+
+def _cached_digest_value(value, backend: str) -> bytes:
+    """like _digest_value, but reuses digests of immutable values"""
+
+    fingerprint = _fingerprint(value)
+    if fingerprint is None:
+        _HASH_CACHE_STATS["uncacheable"] += 1
+        return _digest_value(value, backend)
+
+    key = id(value)
+    entry = _HASH_CACHE.get(key)
+    if (
+        entry is not None
+        and entry[0]() is value
+        and entry[1] == fingerprint
+        and backend in entry[2]
+    ):
+        _HASH_CACHE_STATS["hits"] += 1
+        return entry[2][backend]
+
+    _HASH_CACHE_STATS["misses"] += 1
+    digest = _digest_value(value, backend)
+
+    if entry is not None and entry[0]() is value and entry[1] == fingerprint:
+        entry[2][backend] = digest
+    else:
+        ref = weakref.ref(value, lambda ref: _forget(key, ref))
+        _HASH_CACHE[key] = (ref, fingerprint, {backend: digest})
+
+    return digest
+
+
+def hash_cache_stats() -> dict:
+    """
+    statistics of the cache used by hash_dict(cache=True)
+
+    Returns:
+        dict: with keys hits, misses, uncacheable (values that
+        were not eligible for caching) and entries (number of
+        values currently cached)
+    """
+
+    stats = dict(_HASH_CACHE_STATS)
+    stats["entries"] = len(_HASH_CACHE)
+    return stats
 
-        value = dictionary[key]
 
-        hashes.append(md5hash(value))
+def clear_hash_cache() -> None:
+    """empties the cache used by hash_dict(cache=True), and resets
+    its statistics"""
 
-    return md5hash(hashes)
+    _HASH_CACHE.clear()
+    for key in _HASH_CACHE_STATS:
+        _HASH_CACHE_STATS[key] = 0
 
 
 def dict_to_array(d):
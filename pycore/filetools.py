@@ -1,10 +1,114 @@
 """small tools to help with files"""
 
-import math
+import bisect
+import contextlib
+import glob
+import heapq
+import itertools
+import json
 import os
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
 
+import numpy as np
 from beartype import beartype
 
+from pycore.core import hash_file, resolve_hash_backend
+
+
+# files are stat-ed this many paths at a time, handed to threads in
+# groups of _STAT_GROUP_SIZE
+_STAT_BATCH_SIZE = 4096
+_STAT_GROUP_SIZE = 64
+
+
+def top_files(
+    files,
+    k: int = 10,
+    *,
+    smallest: bool = False,
+    n_workers: Optional[int] = None,
+) -> list:
+    """
+    finds the k largest (or smallest) files
+
+    paths are read lazily and stat-ed in batches on a pool of threads,
+    and only the best k are kept, so memory use doesn't grow with the
+    number of files, and generators of millions of paths are fine.
+
+    Args:
+        files: list or generator of file paths, a folder (all files
+        in it and its subfolders, skipping symbolic links), or a glob
+        pattern ("**" matches subfolders)
+        k (int, optional): number of files to return
+        smallest (bool, optional): find the smallest files instead
+        n_workers (int, optional): number of threads
+
+    Returns:
+        list of (path, size) pairs, largest (or smallest) first.
+        Files of equal size are in the order they were found in.
+        Files that can't be stat-ed (e.g. broken symbolic links, or
+        files deleted since they were listed) and folders that can't
+        be read are skipped
+    """
+
+    assert k > 0, "k should be positive"
+
+    files = _iter_files(files)
+
+    # the root of the heap is the worst file kept so far
+    sign = -1 if smallest else 1
+    heap = []
+    order = 0
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for file, _, size in _stat_files(files, pool):
+            item = (sign * size, -order, file)
+            order += 1
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+
+    heap.sort(reverse=True)
+    return [(file, sign * key) for key, _, file in heap]
+
+
+def _iter_files(files):
+    """iterates over files given as paths, a folder or a glob pattern"""
+
+    if isinstance(files, str):
+        if os.path.isdir(files):
+            return _walk_files(files)
+        return glob.iglob(files, recursive=True)
+    return iter(files)
+
+
+def _walk_files(folder: str):
+    """yields every file in folder and its subfolders, skipping
+    symbolic links, and folders that can't be read"""
+
+    try:
+        entries = os.scandir(folder)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    continue
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                # deleted while we were looking
+                continue
+            if is_dir:
+                yield from _walk_files(entry.path)
+            else:
+                yield entry.path
+
 
 @beartype
 def largest(files: list) -> str:
@@ -17,8 +121,9 @@ def largest(files: list) -> str:
     Returns:
         path pointing to largest file
     """
-    sizes = [os.path.getsize(file) for file in files]
-    return files[sizes.index(max(sizes))]
+    if not files:
+        raise ValueError("files is empty")
+    return top_files(files, 1)[0][0]
 
 
 @beartype
@@ -32,37 +137,432 @@ def smallest(files: list) -> str:
     Returns:
         path pointing to smallest file
     """
-    sizes = [os.path.getsize(file) for file in files]
-    return files[sizes.index(min(sizes))]
+    if not files:
+        raise ValueError("files is empty")
+    return top_files(files, 1, smallest=True)[0][0]
+
+
+def find_duplicates(
+    files,
+    *,
+    partial_bytes: int = 1 << 20,
+    min_size: int = 1,
+    backend: Optional[str] = None,
+    n_workers: Optional[int] = None,
+    index_path: Optional[str] = None,
+) -> list:
+    """
+    finds files with identical contents
+
+    most files are told apart without reading them: files are first
+    grouped by size, then files of the same size by a hash of their
+    first and last partial_bytes, and only files that still match
+    are hashed completely. Files are hashed on a pool of threads.
+
+    If index_path is given, hashes are stored there (as JSON) keyed
+    by device, inode, modification time and size, so files that
+    haven't changed are never read again.
+
+    Hard links to the same file aren't copies, so only the first path
+    found to each file is considered. Files that can't be read (e.g.
+    broken symbolic links, or files deleted during the search) are
+    skipped.
+
+    Args:
+        files: list or generator of file paths, a folder (all files
+        in it and its subfolders, skipping symbolic links), or a glob
+        pattern ("**" matches subfolders)
+        partial_bytes (int, optional): bytes hashed at each end of a
+        file before hashing all of it
+        min_size (int, optional): smaller files are ignored. Empty
+        files are ignored by default
+        backend (str, optional): hash backend, see md5hash
+        n_workers (int, optional): number of threads
+        index_path (str, optional): JSON file to keep hashes in
+
+    Returns:
+        list of groups of duplicate paths (each a list, in the order
+        the files were found), biggest files first
+    """
+
+    backend = resolve_hash_backend(backend)
+
+    index = {}
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+
+    # hashes depend on these, so they are part of what is stored
+    partial = f"{backend} head+tail {partial_bytes}"
+    full = f"{backend} full"
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        by_size = _group_files(
+            file
+            for file in _unique_files(_stat_files(_iter_files(files), pool))
+            if file[2] >= min_size
+        )
+
+        candidates = _duplicate_candidates(by_size)
+        unread = _hash_files(
+            candidates, partial, partial_bytes, backend, pool, index
+        )
+        by_partial = _group_files(
+            (file for file in candidates if file[1] not in unread),
+            lambda key: index[key][partial],
+        )
+
+        # the partial hash already covers all of small files. The index
+        # may still have full hashes of them from other runs, which are
+        # ignored, so that files are compared the same way
+        candidates = _duplicate_candidates(by_partial)
+        big = [file for file in candidates if file[2] > 2 * partial_bytes]
+        unread = _hash_files(big, full, None, backend, pool, index)
+        big_keys = {key for _, key, _ in big}
+        by_full = _group_files(
+            (file for file in candidates if file[1] not in unread),
+            lambda key: (
+                index[key][partial],
+                index[key][full] if key in big_keys else None,
+            ),
+        )
+
+    if index_path is not None:
+        with atomic_write(index_path, "w") as file:
+            json.dump(index, file)
+
+    groups = [same for same in by_full.values() if len(same) > 1]
+    groups.sort(key=lambda same: -same[0][2])
+    return [[path for path, _, _ in same] for same in groups]
+
+
+def _unique_files(files):
+    """skips (path, key, size) of files whose key was already seen,
+    i.e. hard links to a file that was already found"""
+
+    seen = set()
+    for file in files:
+        if file[1] not in seen:
+            seen.add(file[1])
+            yield file
+
+
+def _group_files(files, digest=None) -> dict:
+    """groups (path, key, size) of files by size, and by digest(key)
+    if given"""
+
+    groups = {}
+    for path, key, size in files:
+        group = size if digest is None else (size, digest(key))
+        groups.setdefault(group, []).append((path, key, size))
+    return groups
+
+
+def _duplicate_candidates(groups: dict) -> list:
+    """files in groups of more than one file"""
+    return [file for same in groups.values() if len(same) > 1 for file in same]
+
+
+def _hash_files(files, kind, partial_bytes, backend, pool, index) -> set:
+    """hashes files that aren't in the index yet, and stores the
+    hashes in index[key][kind]
+
+    Returns:
+        keys of the files that couldn't be read
+    """
+
+    todo = [
+        (path, key) for path, key, _ in files if kind not in index.get(key, {})
+    ]
+    digests = pool.map(
+        lambda file: _try_hash_file(file[0], backend, partial_bytes), todo
+    )
+    unread = set()
+    for (_, key), digest in zip(todo, digests):
+        if digest is None:
+            unread.add(key)
+        else:
+            index.setdefault(key, {})[kind] = digest
+    return unread
+
+
+def _stat_files(files, pool):
+    """yields (path, index key, size) of files, stat-ed in batches
+    on a pool of threads. Files that can't be stat-ed are skipped"""
+
+    files = iter(files)
+    while True:
+        batch = list(itertools.islice(files, _STAT_BATCH_SIZE))
+        if not batch:
+            return
+        groups = [
+            batch[i : i + _STAT_GROUP_SIZE]
+            for i in range(0, len(batch), _STAT_GROUP_SIZE)
+        ]
+        stats = itertools.chain.from_iterable(pool.map(_file_stats, groups))
+        for path, stat in zip(batch, stats):
+            if stat is None:
+                continue
+            key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}"
+            yield path, key, stat.st_size
+
+
+def _file_stats(files: list) -> list:
+    """os.stat of some files, or None for files that can't be stat-ed"""
+
+    stats = []
+    for file in files:
+        try:
+            stats.append(os.stat(file))
+        except OSError:
+            # e.g. a broken symbolic link, or deleted since it was listed
+            stats.append(None)
+    return stats
+
+
+def _try_hash_file(
+    path: str, backend: str, partial_bytes: Optional[int]
+) -> Optional[str]:
+    """hash_file, or None if the file can't be read (e.g. it was
+    deleted since it was stat-ed)"""
+
+    try:
+        return hash_file(path, backend=backend, partial_bytes=partial_bytes)
+    except OSError:
+        return None
 
 
 @beartype
-def get_folder_size(start_path: str = ".") -> int:
-    """get total size of folder, including all sub directories"""
-    total_size = 0
+def get_folder_size(
+    start_path: str = ".",
+    *,
+    n_workers: Optional[int] = None,
+    index_path: Optional[str] = None,
+) -> int:
+    """get total size of folder, including all sub directories
+
+    symbolic links are skipped, and not followed. Folders are read with
+    os.scandir on a pool of threads, which helps a lot on network
+    drives, where most of the time is spent waiting on the server.
+
+    If index_path is given, the size of the files in every folder is
+    stored there (as JSON) along with the folder's modification time.
+    Later calls only read folders whose modification time changed,
+    which costs one stat per folder instead of one per file. Note that
+    changing a file in place doesn't change its folder's modification
+    time, so the index only notices files being added, removed or
+    renamed.
+
+    Args:
+        start_path (str, optional): folder to measure
+        n_workers (int, optional): number of threads
+        index_path (str, optional): JSON file to keep folder sizes in
+
+    Returns:
+        size in bytes
+    """
+
+    root = os.path.abspath(start_path)
+
+    index = {}
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+
+    visited = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        pending = {pool.submit(_scan_folder, root, index.get(root))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, entry = future.result()
+                if entry is None:
+                    continue
+                visited[path] = entry
+                for subdir in entry["subdirs"]:
+                    pending.add(
+                        pool.submit(_scan_folder, subdir, index.get(subdir))
+                    )
+
+    if index_path is not None:
+        # keep what is known about other folders
+        index = {
+            path: entry
+            for path, entry in index.items()
+            if not _is_in_folder(path, root)
+        }
+        index.update(visited)
+        with atomic_write(index_path, "w") as file:
+            json.dump(index, file)
 
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            # skip if it is symbolic link
-            if not os.path.islink(fp):
-                total_size += os.path.getsize(fp)
+    return sum(entry["files_size"] for entry in visited.values())
 
-    return total_size
+
+def _scan_folder(path: str, known: Optional[dict]) -> tuple:
+    """size of the files directly in a folder, and its subfolders.
+    If known (from the index) has the folder's current modification
+    time, it is returned as is
+
+    Returns:
+        path, dict with mtime_ns, files_size and subdirs, or None
+        if the folder can't be read
+    """
+
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None
+
+    if known is not None and known["mtime_ns"] == mtime_ns:
+        return path, known
+
+    files_size = 0
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        files_size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    # deleted while we were looking
+                    continue
+    except OSError:
+        return path, None
+
+    return path, dict(
+        mtime_ns=mtime_ns, files_size=files_size, subdirs=subdirs
+    )
+
+
+def _is_in_folder(path: str, folder: str) -> bool:
+    """checks if path is folder, or anything inside it"""
+    return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "wb"):
+    """
+    context manager that writes a file without readers ever seeing a
+    partially written file
+
+    with atomic_write("result.npy") as file:
+        np.save(file, arr)
+
+    the file object writes to a temporary file in the same folder,
+    which replaces path once the with block finishes. If the block
+    raises, the temporary file is removed and path is left as it was.
+    The file gets the same permissions as one made with open()
+
+    Args:
+        path (str): file to write
+        mode (str, optional): "wb" for bytes, or "w" for text
+
+    Yields:
+        file object opened with mode
+    """
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        # mkstemp makes files only their owner can read
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, 0o666 & ~_umask())
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+_umask_lock = threading.Lock()
+
+
+def _umask() -> int:
+    """the process's umask. It can only be read by setting it, so
+    this is done under a lock"""
+
+    with _umask_lock:
+        umask = os.umask(0o022)
+        os.umask(umask)
+    return umask
+
+
+# base and unit names for each choice of units in format_bytes
+_BYTE_UNITS = dict(
+    binary=(1024, ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")),
+    iec=(1024, ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")),
+    si=(1000, ("B", "kB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")),
+)
 
 
 @beartype
-def format_bytes(size_bytes: int) -> str:
+def format_bytes(size_bytes: int, *, units: str = "binary") -> str:
     """converts bytes into MB, GB, etc. for a humans
 
     from here:
 
     https://stackoverflow.com/questions/5194057/better-way-to-convert-file-sizes-in-python
+
+    Args:
+        size_bytes (int): number of bytes, can be negative
+        units (str, optional): "binary" (1 KB = 1024 B, the default),
+        "iec" (1 KiB = 1024 B) or "si" (1 kB = 1000 B)
+
+    Returns:
+        e.g. "1.5 MB"
     """
     if size_bytes == 0:
         return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return "%s %s" % (s, size_name[i])
+    powers, names = _byte_units(units)
+    magnitude = float(abs(size_bytes))
+    i = bisect.bisect_right(powers, magnitude) - 1
+    s = round(magnitude / powers[i], 2)
+    sign = "-" if size_bytes < 0 else ""
+    return "%s%s %s" % (sign, s, names[i])
+
+
+def format_bytes_array(sizes, *, units: str = "binary") -> np.ndarray:
+    """format_bytes for many sizes at once
+
+    Args:
+        sizes: numpy array, pandas Series or list of numbers of bytes
+        units (str, optional): see format_bytes
+
+    Returns:
+        np.ndarray of strings, the same as calling format_bytes on
+        every size
+    """
+
+    powers, names = _byte_units(units)
+    sizes = np.asarray(sizes)
+    magnitude = np.abs(sizes).astype(float)
+
+    i = np.searchsorted(powers, magnitude, side="right") - 1
+    i = np.maximum(i, 0)
+    scaled = magnitude / np.array(powers)[i]
+
+    # np.round scales by 100 and rounds to an integer, which can round
+    # the other way from python's round when it is close to a tie
+    rounded = np.round(scaled, 2)
+    near_tie = np.abs((scaled * 100) % 1 - 0.5) < 1e-6
+    for j in np.flatnonzero(near_tie):
+        rounded.flat[j] = round(float(scaled.flat[j]), 2)
+
+    signs = np.where(sizes < 0, "-", "")
+    units = np.char.add(" ", np.array(names)[i])
+    formatted = np.char.add(np.char.add(signs, rounded.astype(str)), units)
+    return np.where(sizes == 0, "0B", formatted)
+
+
+def _byte_units(units: str) -> tuple:
+    """powers of the base (as floats) and names of units"""
+
+    assert units in _BYTE_UNITS, f"units should be one of {list(_BYTE_UNITS)}"
+    base, names = _BYTE_UNITS[units]
+    return [float(base**i) for i in range(len(names))], names
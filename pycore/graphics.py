@@ -3,6 +3,7 @@ This module contains helper graphics functions for making figures, subplots
 and modifying plots
 """
 
+import os
 from typing import Optional
 
 import bokeh
@@ -11,10 +12,13 @@ import matplotlib.transforms as mtransforms
 import numpy as np
 import pandas as pd
 import scipy.stats
+from bokeh.core.property.validation import validate
+from bokeh.models import CDSView, ColumnDataSource, IndexFilter
 from bokeh.plotting import figure
 from matplotlib import cm
 
-from pycore.core import dict_to_array, format_p_value
+from pycore.core import dict_to_array, format_p_value, md5hash
+from pycore.filetools import atomic_write
 from pycore.validate import (
     check_all_arrays_same_shape,
     check_axis,
@@ -51,21 +55,36 @@ def scatter_groups(
         y_axis_type=y_axis_type,
     )
 
-    groups = data[group_by].unique()
+    # one pass over the data to find groups, in order of appearance
+    codes, groups = pd.factorize(data[group_by], use_na_sentinel=False)
 
     if len(groups) < 9:
         colors = bokeh.palettes.Colorblind[8]
     else:
-        colors = bokeh.palettes.Viridis256[255]
-
-    for i, group in enumerate(groups):
-        xx = list(data[x][data[group_by] == group])
-        yy = list(data[y][data[group_by] == group])
-        fig.circle(
-            xx,
-            yy,
+        colors = bokeh.palettes.viridis(len(groups))
+
+    # all groups share one source of numpy arrays, which bokeh sends
+    # in binary. Every group is a view of the rows in that group, so
+    # that clicking on the legend can hide it
+    source = ColumnDataSource(
+        data=dict(x=data[x].to_numpy(), y=data[y].to_numpy())
+    )
+    order = np.argsort(codes, kind="stable").astype(np.int32)
+    edges = np.cumsum(np.bincount(codes, minlength=len(groups)))
+
+    for i, rows in enumerate(np.split(order, edges[:-1])):
+        # bokeh would otherwise check every index one at a time
+        with validate(False):
+            view = CDSView(filter=IndexFilter(rows))
+
+        fig.scatter(
+            "x",
+            "y",
+            source=source,
+            view=view,
+            marker="circle",
             alpha=0.5,
-            legend_label=group,
+            legend_label=str(groups[i]),
             hover_alpha=1,
             fill_color=colors[i],
             line_color=colors[i],
@@ -108,6 +127,248 @@ def subsample(x: np.ndarray, bin_size: int = 50) -> np.ndarray:
     return reduced_x
 
 
+# minmax_decimate reads arrays in blocks of about this many bytes
+_DECIMATE_BLOCK_BYTES = 1 << 24
+
+
+def minmax_decimate(data, bin_size: int = 50, *, axis: int = 0) -> tuple:
+    """
+    min-max resampler for plotting many channels of long traces
+
+    like subsample, but samples are binned along axis of an N-D array
+    (e.g. samples x channels), the last partial bin is kept, and the
+    positions of the min and max of every bin are returned too, so
+    that spikes are drawn where they happened. Within every bin, the
+    min and max are put in the order they occurred in.
+
+    data can be a np.ndarray, a np.memmap (read one block at a time)
+    or an iterable of chunks, concatenated along axis, so that a long
+    recording can be decimated in one pass without loading it.
+
+    this destroys and alters data, and should only be used
+    for plots!
+
+    Args:
+        data: array, memmap or iterable of arrays
+        bin_size (int): min and max are computed on bins of this many
+        samples (default 50)
+        axis (int): axis along which samples go (default 0)
+
+    Returns:
+        x: sample index of every min and max
+        y: the min and max values. x and y have the shape of data,
+        but with 2 * ceil(n_samples / bin_size) samples along axis
+    """
+
+    assert bin_size > 0, "bin_size should be positive"
+
+    if isinstance(data, np.ndarray):
+        chunks = _array_blocks(np.moveaxis(data, axis, 0), bin_size)
+    else:
+        chunks = (np.moveaxis(np.asarray(chunk), axis, 0) for chunk in data)
+
+    xs = []
+    ys = []
+    offset = 0
+    leftover = None
+    for chunk in chunks:
+        if leftover is not None and len(leftover):
+            chunk = np.concatenate((leftover, chunk))
+        n_full = len(chunk) // bin_size * bin_size
+
+        x, y = _minmax_bins(chunk[:n_full], bin_size, offset)
+        xs.append(x)
+        ys.append(y)
+
+        leftover = chunk[n_full:]
+        offset += n_full
+
+    assert leftover is not None, "data is empty"
+
+    # the last partial bin
+    if len(leftover):
+        x, y = _minmax_bins(leftover, len(leftover), offset)
+        xs.append(x)
+        ys.append(y)
+
+    x = np.moveaxis(np.concatenate(xs), 0, axis)
+    y = np.moveaxis(np.concatenate(ys), 0, axis)
+    return x, y
+
+
+def _array_blocks(arr: np.ndarray, bin_size: int):
+    """yields blocks of whole bins along the first axis of arr"""
+
+    row_bytes = max(1, arr[:1].nbytes)
+    n_bins = max(1, _DECIMATE_BLOCK_BYTES // (row_bytes * bin_size))
+    block = n_bins * bin_size
+
+    # an empty block, so that empty arrays give empty outputs
+    yield np.asarray(arr[:0])
+    for start in range(0, len(arr), block):
+        yield np.asarray(arr[start : start + block])
+
+
+def _minmax_bins(chunk: np.ndarray, bin_size: int, offset: int) -> tuple:
+    """min and max of every bin along the first axis of chunk, in the
+    order they occur, with their sample indices"""
+
+    n_bins = len(chunk) // bin_size
+    bins = chunk.reshape((n_bins, bin_size) + chunk.shape[1:])
+
+    i_min = bins.argmin(axis=1)[:, np.newaxis]
+    i_max = bins.argmax(axis=1)[:, np.newaxis]
+    first = np.minimum(i_min, i_max)
+    second = np.maximum(i_min, i_max)
+
+    # (n_bins, 2, ...) -> (2 * n_bins, ...)
+    positions = np.concatenate((first, second), axis=1)
+    y = np.take_along_axis(bins, positions, axis=1)
+    x = positions + (offset + bin_size * np.arange(n_bins)).reshape(
+        (n_bins, 1) + (1,) * (chunk.ndim - 1)
+    )
+
+    shape = (2 * n_bins,) + chunk.shape[1:]
+    return x.reshape(shape), y.reshape(shape)
+
+
+class MinMaxPyramid:
+    """
+    multi-resolution min-max summary of a trace, for plots that can
+    be panned and zoomed without decimating the whole trace again
+
+    level 0 is minmax_decimate(trace, bin_size), and every next level
+    has bins factor times bigger, up to a single bin. query() picks
+    the finest level that fits in the requested number of points, so
+    it costs O(n_points), no matter how long the trace is.
+
+    The pyramid takes about 2 / bin_size times the memory of the
+    trace (plus sample indices). If cache_dir is given, it is stored
+    there as .npy files named by md5hash of the trace, and memmapped
+    from there the next time the same trace is used.
+
+    Args:
+        trace (np.ndarray): 1-D trace, or np.memmap
+        bin_size (int): samples per bin in the finest level
+        factor (int): ratio of bin sizes between levels
+        cache_dir (str, optional): folder to store the pyramid in
+    """
+
+    def __init__(
+        self,
+        trace: np.ndarray,
+        *,
+        bin_size: int = 64,
+        factor: int = 4,
+        cache_dir: Optional[str] = None,
+    ):
+        check_vector(trace)
+        assert bin_size > 0, "bin_size should be positive"
+        assert factor > 1, "factor should be more than 1"
+
+        self.trace = trace
+        self.bin_size = bin_size
+        self.factor = factor
+        self.n_samples = len(trace)
+
+        if cache_dir is None:
+            x, y = self._build()
+        else:
+            x, y = self._load_or_build(cache_dir)
+
+        # levels are stored one after the other in x and y
+        self.bin_sizes = []
+        self.levels = []
+        start = 0
+        for level_bin_size, n_bins in self._level_sizes():
+            self.bin_sizes.append(level_bin_size)
+            stop = start + 2 * n_bins
+            self.levels.append((x[start:stop], y[start:stop]))
+            start = stop
+
+    def query(self, start: int, stop: int, n_points: int = 2000) -> tuple:
+        """
+        at most n_points min/max points covering samples [start, stop)
+
+        if the range has at most n_points samples, the samples
+        themselves are returned. Otherwise, the first and last points
+        can come from bins that stick out of the range.
+
+        Args:
+            start (int): first sample
+            stop (int): last sample (exclusive)
+            n_points (int): maximum number of points to return
+
+        Returns:
+            x: sample index of every point
+            y: value of every point
+        """
+
+        start = max(0, int(start))
+        stop = min(self.n_samples, int(stop))
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64), np.asarray(self.trace[:0])
+
+        if stop - start <= n_points:
+            return np.arange(start, stop), np.asarray(self.trace[start:stop])
+
+        # the finest level that fits, or the coarsest one
+        for (x, y), level_bin_size in zip(self.levels, self.bin_sizes):
+            first = start // level_bin_size
+            last = -(-stop // level_bin_size)
+            if 2 * (last - first) <= n_points:
+                break
+
+        return (
+            np.asarray(x[2 * first : 2 * last]),
+            np.asarray(y[2 * first : 2 * last]),
+        )
+
+    def _level_sizes(self) -> list:
+        """(bin size, number of bins) of every level"""
+
+        sizes = []
+        level_bin_size = self.bin_size
+        while True:
+            n_bins = -(-self.n_samples // level_bin_size)
+            sizes.append((level_bin_size, n_bins))
+            if n_bins <= 1:
+                return sizes
+            level_bin_size *= self.factor
+
+    def _build(self) -> tuple:
+        """decimates the trace, then every level to make the next"""
+
+        x, y = minmax_decimate(self.trace, self.bin_size)
+        xs = [x]
+        ys = [y]
+        while len(x) > 2:
+            # every bin of the next level is 2 * factor points
+            positions, y = minmax_decimate(y, 2 * self.factor)
+            x = x[positions]
+            xs.append(x)
+            ys.append(y)
+
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def _load_or_build(self, cache_dir: str) -> tuple:
+        """memmaps a stored pyramid, or builds and stores one"""
+
+        key = md5hash([self.trace, self.bin_size, self.factor])
+        paths = [
+            os.path.join(cache_dir, f"{key.replace(':', '-')}_{name}.npy")
+            for name in ("x", "y")
+        ]
+
+        if not all(os.path.exists(path) for path in paths):
+            os.makedirs(cache_dir, exist_ok=True)
+            for path, arr in zip(paths, self._build()):
+                with atomic_write(path) as file:
+                    np.save(file, arr, allow_pickle=False)
+
+        return tuple(np.load(path, mmap_mode="r") for path in paths)
+
+
 def plot_pairwise(
     x: np.ndarray,
     y: np.ndarray,
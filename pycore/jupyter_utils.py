@@ -19,7 +19,9 @@ def offer_editable_mpl_figure(func):
 
         hashes.append(hash_dict(kwargs))
 
-        arghash = md5hash(hashes)
+        # digests other than md5 look like "blake2b:...", and ':'
+        # can't be in file names on Windows, or in Markdown links
+        arghash = md5hash(hashes).replace(":", "-")
 
         fig = func(*args, **kwargs)
 
@@ -32,8 +34,9 @@ def offer_editable_mpl_figure(func):
             formats=[".pdf"],
         )
 
+        short_hash = arghash.rpartition("-")[2][0:7]
         display(
-            Markdown(f"[↓ ᴇᴅɪᴛᴀʙʟᴇ ꜰɪɢᴜʀᴇ ({arghash[0:7]})]({file_name}.pdf)")
+            Markdown(f"[↓ ᴇᴅɪᴛᴀʙʟᴇ ꜰɪɢᴜʀᴇ ({short_hash})]({file_name}.pdf)")
         )
 
     return _wrapper
@@ -3,89 +3,726 @@ contains useful maths-related functions
 """
 
 
+import collections
+import os
+from typing import Optional
+
 import numpy as np
-import pandas as pd
-import scipy
-import scipy.cluster.hierarchy as sch
-from scipy import stats
 
-from pycore.matlab import chunk_index
+from pycore.core import is_pandas, md5hash
+
+
+# cluster_corr(method="auto") switches from exact to sampled
+# clustering above this many variables
+_CLUSTER_EXACT_MAX = 5000
 
+# distances are computed on blocks of this many bytes at a time
+_DISTANCE_BLOCK_BYTES = 1 << 26
 
-def cluster_corr(corr_array, inplace=False):
+
+def cluster_corr(
+    corr_array,
+    inplace=False,
+    *,
+    method: str = "exact",
+    dtype=np.float32,
+    sample_size: int = 2000,
+    seed: int = 0,
+    cache: bool = True,
+):
     """
     Rearranges the correlation matrix, corr_array, so that groups of highly
     correlated variables are next to eachother
 
+    Variables are clustered using complete linkage on the euclidean
+    distances between rows of corr_array. For large matrices, method
+    can be used to trade exactness for speed and memory:
+
+    - "exact": distances are computed with scipy's pdist, as before
+    - "blockwise": distances are computed using matrix products on
+      blocks of rows, in dtype (float32 by default). Much faster
+      than pdist, but still needs O(N^2) memory for the linkage
+    - "sample": a random subset of sample_size variables is
+      clustered (blockwise), and every variable is then assigned to
+      the cluster whose mean row is nearest to it. Needs
+      O(N * sample_size) time and memory
+    - "auto": "exact" for small matrices, "sample" for large ones
+
     Parameters
     ----------
     corr_array : pandas.DataFrame or numpy.ndarray
         a NxN correlation matrix
+    inplace : bool
+        if True (and corr_array is a numpy.ndarray), corr_array is
+        rearranged in place, using O(N) extra memory
+    method : str
+        "exact", "blockwise", "sample" or "auto"
+    dtype : numpy dtype
+        precision of distances for "blockwise" and "sample"
+    sample_size : int
+        number of variables to cluster for "sample"
+    seed : int
+        seed used to pick variables for "sample"
+    cache : bool
+        reuse the clustering of an identical matrix, see
+        fit_cluster_corr
 
     Returns
     -------
     pandas.DataFrame or numpy.ndarray
         a NxN correlation matrix with the columns and rows rearranged
     """
-    pairwise_distances = sch.distance.pdist(corr_array)
+
+    clustering = fit_cluster_corr(
+        corr_array,
+        method=method,
+        dtype=dtype,
+        sample_size=sample_size,
+        seed=seed,
+        cache=cache,
+    )
+    return clustering.apply(corr_array, inplace=inplace)
+
+
+class CorrClustering:
+    """
+    The clustering of a correlation matrix, made by fit_cluster_corr.
+
+    It can reorder other matrices of the same variables without
+    clustering again, and be extended with new variables by assigning
+    them to the nearest existing cluster.
+
+    Attributes
+    ----------
+    linkage : numpy.ndarray
+        scipy linkage matrix of the clustered variables. For
+        method="sample", this only covers the sampled variables
+    threshold : float
+        distance at which the linkage was cut into clusters
+    labels : numpy.ndarray
+        cluster of every variable
+    permutation : numpy.ndarray
+        order of the variables that puts clusters next to eachother
+    index : pandas.Index or None
+        names of the variables, if fitted on a DataFrame
+    """
+
+    def __init__(
+        self,
+        *,
+        linkage: np.ndarray,
+        threshold: float,
+        labels: np.ndarray,
+        permutation: Optional[np.ndarray] = None,
+        index=None,
+    ):
+        self.linkage = linkage
+        self.threshold = threshold
+        self.labels = labels
+        if permutation is None:
+            permutation = np.argsort(labels)
+        self.permutation = permutation
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __repr__(self) -> str:
+        n_clusters = len(np.unique(self.labels))
+        return f"CorrClustering({len(self)} variables, {n_clusters} clusters)"
+
+    def apply(self, corr_array, inplace=False):
+        """
+        Rearranges a NxN matrix of the same variables in the order of
+        this clustering
+
+        Parameters
+        ----------
+        corr_array : pandas.DataFrame or numpy.ndarray
+            a NxN matrix
+        inplace : bool
+            if True (and corr_array is a numpy.ndarray), corr_array is
+            rearranged in place, using O(N) extra memory
+
+        Returns
+        -------
+        pandas.DataFrame or numpy.ndarray
+            the matrix with the columns and rows rearranged
+        """
+
+        n = len(self)
+        assert np.shape(corr_array) == (
+            n,
+            n,
+        ), f"Expected a {n}x{n} matrix, got {np.shape(corr_array)}"
+
+        idx = self.permutation
+
+        if is_pandas(corr_array, series=False):
+            return corr_array.iloc[idx, idx]
+
+        if inplace:
+            _permute_inplace(corr_array, idx)
+            return corr_array
+
+        return corr_array[np.ix_(idx, idx)]
+
+    def add_variables(self, corr_array, *, dtype=np.float32):
+        """
+        Extends the clustering to a bigger matrix that contains the
+        variables this was fitted on plus some new ones, without
+        clustering again
+
+        Every new variable is put in the cluster whose mean row (over
+        the old variables) is nearest to it, after the old members of
+        that cluster. The old variables keep their relative order.
+
+        Parameters
+        ----------
+        corr_array : pandas.DataFrame or numpy.ndarray
+            a MxM correlation matrix, M >= N. For DataFrames, the old
+            variables are found by name. For arrays, they must be the
+            first N rows/columns
+        dtype : numpy dtype
+            precision of distances to cluster centers
+
+        Returns
+        -------
+        CorrClustering
+            a clustering of all M variables
+        """
+
+        values = np.asarray(corr_array)
+        n_old = len(self)
+        n_total = values.shape[0]
+        assert values.shape == (
+            n_total,
+            n_total,
+        ), f"Expected a square matrix, got {values.shape}"
+
+        if is_pandas(corr_array, series=False) and self.index is not None:
+            old = corr_array.index.get_indexer(self.index)
+            assert np.all(old >= 0), "Some old variables are missing"
+            is_new = np.ones(n_total, dtype=bool)
+            is_new[old] = False
+            new = np.flatnonzero(is_new)
+        else:
+            assert n_total >= n_old, "Matrix has fewer variables than before"
+            old = np.arange(n_old)
+            new = np.arange(n_old, n_total)
+
+        cluster_ids, centers = _cluster_centers(
+            values[np.ix_(old, old)], self.labels, dtype
+        )
+        distances = _distances(values[np.ix_(new, old)], centers)
+
+        labels = np.empty(n_total, dtype=self.labels.dtype)
+        labels[old] = self.labels
+        labels[new] = cluster_ids[np.argmin(distances, axis=1)]
+
+        # sort by cluster, then old variables in their old order,
+        # then new variables
+        rank = np.empty(n_total, dtype=np.int64)
+        rank[old[self.permutation]] = np.arange(n_old)
+        rank[new] = np.arange(n_old, n_total)
+
+        index = None
+        if is_pandas(corr_array, series=False):
+            index = corr_array.index
+
+        return CorrClustering(
+            linkage=self.linkage,
+            threshold=self.threshold,
+            labels=labels,
+            permutation=np.lexsort((rank, labels)),
+            index=index,
+        )
+
+
+# fit_cluster_corr remembers this many clusterings
+_CLUSTERING_CACHE_SIZE = 32
+
+# hash of matrix and options -> CorrClustering, least recently used first
+_CLUSTERING_CACHE = collections.OrderedDict()
+
+
+def fit_cluster_corr(
+    corr_array,
+    *,
+    method: str = "exact",
+    dtype=np.float32,
+    sample_size: int = 2000,
+    seed: int = 0,
+    cache: bool = True,
+) -> CorrClustering:
+    """
+    Clusters the variables of a correlation matrix like cluster_corr,
+    but returns the clustering instead of the rearranged matrix, so
+    that it can be applied to other matrices, or extended with new
+    variables
+
+    If cache is True, the clustering is stored under a hash of
+    corr_array and the options, and clustering an identical matrix
+    again only costs hashing it. The last 32 clusterings are kept.
+
+    Parameters
+    ----------
+    corr_array : pandas.DataFrame or numpy.ndarray
+        a NxN correlation matrix
+    method, dtype, sample_size, seed :
+        see cluster_corr
+    cache : bool
+        reuse the clustering of an identical matrix
+
+    Returns
+    -------
+    CorrClustering
+    """
+
+    assert method in (
+        "exact",
+        "blockwise",
+        "sample",
+        "auto",
+    ), f"Unknown method: {method}"
+
+    if not cache:
+        return _fit_clustering(
+            corr_array,
+            method=method,
+            dtype=dtype,
+            sample_size=sample_size,
+            seed=seed,
+        )
+
+    key = md5hash([corr_array, method, np.dtype(dtype).str, sample_size, seed])
+    if key in _CLUSTERING_CACHE:
+        _CLUSTERING_CACHE.move_to_end(key)
+        return _CLUSTERING_CACHE[key]
+
+    clustering = _fit_clustering(
+        corr_array,
+        method=method,
+        dtype=dtype,
+        sample_size=sample_size,
+        seed=seed,
+    )
+
+    _CLUSTERING_CACHE[key] = clustering
+    while len(_CLUSTERING_CACHE) > _CLUSTERING_CACHE_SIZE:
+        _CLUSTERING_CACHE.popitem(last=False)
+
+    return clustering
+
+
+def _fit_clustering(corr_array, *, method, dtype, sample_size, seed):
+    """clusters the variables of corr_array"""
+
+    import scipy.cluster.hierarchy as sch
+
+    values = np.asarray(corr_array)
+    n = values.shape[0]
+
+    if method == "auto":
+        method = "exact" if n <= _CLUSTER_EXACT_MAX else "sample"
+
+    if method == "sample" and n <= sample_size:
+        method = "blockwise"
+
+    if method == "exact":
+        linkage, threshold, labels = _cluster_labels(
+            sch.distance.pdist(values)
+        )
+
+    elif method == "blockwise":
+        linkage, threshold, labels = _cluster_labels(
+            _condensed_distances(values, dtype)
+        )
+
+    else:
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, size=sample_size, replace=False))
+        sample_rows = values[sample].astype(dtype)
+        linkage, threshold, sample_labels = _cluster_labels(
+            _condensed_distances(sample_rows, dtype)
+        )
+
+        # assign everything to the nearest cluster center
+        cluster_ids, centers = _cluster_centers(
+            sample_rows, sample_labels, dtype
+        )
+        labels = np.empty(n, dtype=sample_labels.dtype)
+        block = max(1, _DISTANCE_BLOCK_BYTES // (n * centers.itemsize))
+        for first in range(0, n, block):
+            distances = _distances(values[first : first + block], centers)
+            labels[first : first + block] = cluster_ids[
+                np.argmin(distances, axis=1)
+            ]
+
+    index = None
+    if is_pandas(corr_array, series=False):
+        index = corr_array.index
+
+    return CorrClustering(
+        linkage=linkage, threshold=threshold, labels=labels, index=index
+    )
+
+
+def _cluster_labels(pairwise_distances: np.ndarray) -> tuple:
+    """complete-linkage clusters, cut at half the largest distance
+
+    Returns:
+        linkage, threshold, labels
+    """
+
+    import scipy.cluster.hierarchy as sch
+
     linkage = sch.linkage(pairwise_distances, method="complete")
     cluster_distance_threshold = pairwise_distances.max() / 2
-    idx_to_cluster_array = sch.fcluster(
+    labels = sch.fcluster(
         linkage, cluster_distance_threshold, criterion="distance"
     )
-    idx = np.argsort(idx_to_cluster_array)
+    return linkage, float(cluster_distance_threshold), labels
+
+
+def _cluster_centers(rows: np.ndarray, labels: np.ndarray, dtype) -> tuple:
+    """mean row of every cluster
+
+    Returns:
+        cluster_ids, centers (one row per cluster id)
+    """
+
+    cluster_ids, inverse = np.unique(labels, return_inverse=True)
+    n = len(labels)
+    membership = np.zeros((len(cluster_ids), n), dtype=dtype)
+    membership[inverse.reshape(-1), np.arange(n)] = 1
+    membership /= membership.sum(axis=1, keepdims=True)
+    return cluster_ids, membership @ rows.astype(dtype, copy=False)
+
+
+def _distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """euclidean distances between every row of a and every row of b,
+    using a matrix product, in the precision of b"""
+
+    a = a.astype(b.dtype, copy=False)
+    squared = (
+        np.einsum("ij,ij->i", a, a)[:, np.newaxis]
+        + np.einsum("ij,ij->i", b, b)[np.newaxis, :]
+        - 2 * (a @ b.T)
+    )
+    np.maximum(squared, 0, out=squared)
+    return np.sqrt(squared)
+
+
+def _condensed_distances(values: np.ndarray, dtype) -> np.ndarray:
+    """like scipy's pdist, but computed blockwise using matrix
+    products in some dtype"""
+
+    values = np.asarray(values, dtype=dtype)
+    n = values.shape[0]
+    condensed = np.empty(n * (n - 1) // 2, dtype=dtype)
+
+    block = max(1, _DISTANCE_BLOCK_BYTES // (n * values.itemsize))
+    start = 0
+    for first in range(0, n, block):
+        distances = _distances(values[first : first + block], values)
+        for i, row in enumerate(distances, start=first):
+            condensed[start : start + n - i - 1] = row[i + 1 :]
+            start += n - i - 1
+
+    return condensed
+
+
+def _permute_inplace(a: np.ndarray, idx: np.ndarray) -> None:
+    """does a[:] = a[idx][:, idx], using only one row of extra memory
+
+    rows are moved along the cycles of the permutation, and every
+    row's columns are permuted as it is moved
+    """
 
-    if not inplace:
-        corr_array = corr_array.copy()
+    n = a.shape[0]
+    visited = np.zeros(n, dtype=bool)
+
+    for start in range(n):
+        if visited[start]:
+            continue
+
+        first_row = a[start, idx]
+        i = start
+        while True:
+            visited[i] = True
+            source = idx[i]
+            if source == start:
+                a[i] = first_row
+                break
+            a[i] = a[source, idx]
+            i = source
 
-    if isinstance(corr_array, pd.DataFrame):
-        return corr_array.iloc[idx, :].T.iloc[idx, :]
-    return corr_array[idx, :][:, idx]
+
+# cross_correlation works on this many bytes of spectra at a time
+_XCORR_BLOCK_BYTES = 1 << 26
 
 
 def cross_correlation(
-    x: np.array,
-    y: np.array,
+    x,
+    y,
     *,
     chunk_size: int = 1000,
+    dtype=None,
+    out=None,
 ):
     """computes the cross correlation between two vectors
 
-    a wrapper around scipy.correlate, with the following tricks:
+    equivalent to scipy.signal.correlate, with the following tricks:
 
     - sane defaults
     - auto zscoring
     - splits signals into smaller chunks and computes in each chunk
 
+    all chunks are z-scored and correlated at once, using a
+    batched FFT. A trailing chunk that is shorter than chunk_size
+    is not used, and its column is left as NaN.
+
+    Signals that don't fit in memory can be passed as np.memmaps,
+    or as paths to raw binary files (together with their dtype).
+    They are read in blocks of whole chunks, and results can be
+    written to a memory-mapped output, so memory use doesn't grow
+    with the length of the signals.
 
+    Args:
+        x (np.array, np.memmap or path): some signal
+        y (np.array, np.memmap or path): some other signal,
+        as long as x
+        chunk_size (int, optional): length of each chunk
+        dtype (optional): dtype of x and y, if they are paths to
+        raw binary files
+        out (np.array or path, optional): where to write the result.
+        Either a (chunk_size, number of chunks) float array, or a
+        path where a .npy file is created and memory-mapped
+
+    Returns:
+        c: np.array of shape (chunk_size, number of chunks).
+        c[:, i] is the cross correlation of the ith chunks of x and y
+        (in "same" mode), normalized by chunk_size
     """
 
-    if np.any(np.isnan(x)):
-        raise RuntimeError("nans in x")
+    x = _as_signal(x, dtype)
+    y = _as_signal(y, dtype)
 
-    if np.any(np.isnan(y)):
-        raise RuntimeError("nans in y")
+    assert x.shape == y.shape, "x and y should be the same size"
 
-    x = x.flatten()
-    y = y.flatten()
+    n = min(chunk_size, x.shape[0])
+    n_chunks = int(np.ceil(x.shape[0] / chunk_size))
+    n_full_chunks = x.shape[0] // n
 
-    idx = chunk_index(x, chunk_size=chunk_size)
+    c = _make_output(out, (n, n_chunks))
 
-    groups = np.unique(idx)
+    fft_size = _fft_size(n, n // 2)
+    block = max(1, _XCORR_BLOCK_BYTES // (fft_size * 16))
 
-    a = stats.zscore(x[idx == groups[0]])
-    c = np.full((len(a), len(groups)), np.nan)
+    for first in range(0, n_full_chunks, block):
+        last = min(first + block, n_full_chunks)
 
-    for i, group in enumerate(groups):
-        a = stats.zscore(x[idx == group])
-        b = stats.zscore(y[idx == group])
+        a = np.asarray(x[first * n : last * n], dtype=np.float64)
+        if np.any(np.isnan(a)):
+            raise RuntimeError("nans in x")
 
-        if len(a) != c.shape[0]:
-            continue
+        b = np.asarray(y[first * n : last * n], dtype=np.float64)
+        if np.any(np.isnan(b)):
+            raise RuntimeError("nans in y")
+
+        c[:, first:last] = _chunk_correlations(
+            a.reshape(-1, n), b.reshape(-1, n)
+        ).T
+
+    if n_full_chunks < n_chunks:
+        c[:, n_full_chunks:] = np.nan
+
+    if isinstance(c, np.memmap):
+        c.flush()
 
-        try:
-            c[:, i] = scipy.signal.correlate(a, b, mode="same")
-            c[:, i] /= len(a)
-        except Exception:
-            pass
     return c
+
+
+def _as_signal(x, dtype) -> np.ndarray:
+    """turns x into a vector without copying it. Paths are
+    memory-mapped as raw binary files of some dtype"""
+
+    if isinstance(x, (str, os.PathLike)):
+        assert dtype is not None, "dtype is needed to read raw files"
+        return np.memmap(x, dtype=dtype, mode="r")
+
+    # unlike flatten, this doesn't copy contiguous arrays
+    return np.asanyarray(x).reshape(-1)
+
+
+def _make_output(out, shape: tuple) -> np.ndarray:
+    """makes (or checks) the output of cross_correlation"""
+
+    if out is None:
+        return np.full(shape, np.nan)
+
+    if isinstance(out, (str, os.PathLike)):
+        # fortran order, so that every chunk's column is
+        # contiguous on disk
+        return np.lib.format.open_memmap(
+            out,
+            mode="w+",
+            dtype=np.float64,
+            shape=shape,
+            fortran_order=True,
+        )
+
+    assert out.shape == shape, f"out should have shape {shape}"
+    return out
+
+
+def _fft_size(n: int, max_lag: int) -> int:
+    """smallest fast FFT size that gives the circular correlation of
+    two signals of length n, without wrap-around, up to max_lag"""
+
+    import scipy.fft
+
+    return scipy.fft.next_fast_len(n + max_lag, real=True)
+
+
+def _zscore_rows(a: np.ndarray) -> np.ndarray:
+    """z-scores every row of a matrix. Rows with no variance
+    become NaN, like scipy.stats.zscore"""
+
+    a = np.asarray(a, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (a - a.mean(axis=1, keepdims=True)) / a.std(
+            axis=1, keepdims=True
+        )
+
+
+def _chunk_correlations(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """cross correlations between matching rows of a and b
+
+    rows are z-scored and correlated using one batched FFT
+
+    Args:
+        a (np.ndarray): (number of chunks, n) matrix
+        b (np.ndarray): matrix the same size as a
+
+    Returns:
+        np.ndarray: (number of chunks, n) matrix. Row i is the
+        correlation of a[i] and b[i] in "same" mode, divided by n
+    """
+
+    import scipy.fft
+
+    n = a.shape[1]
+    fft_size = _fft_size(n, n // 2)
+
+    fa = scipy.fft.rfft(_zscore_rows(a), fft_size, axis=1)
+    fb = scipy.fft.rfft(_zscore_rows(b), fft_size, axis=1)
+    full = scipy.fft.irfft(fa * np.conj(fb), fft_size, axis=1)
+
+    # lags of the "same" part of the full correlation
+    lags = np.arange(n) - n // 2
+    return full[:, lags % fft_size] / n
+
+
+def cross_correlation_matrix(
+    X: np.ndarray,
+    *,
+    max_lag: Optional[int] = None,
+    reduce: Optional[str] = None,
+    n_jobs: Optional[int] = None,
+):
+    """cross correlations between every pair of channels
+
+    every channel is z-scored and Fourier transformed once, and the
+    spectra are reused for every pair. Since the correlation of
+    (j, i) is the correlation of (i, j) reversed in time, only
+    pairs with i <= j are computed. Inverse FFTs are run on
+    n_jobs threads.
+
+    Args:
+        X (np.ndarray): (number of samples, number of channels) matrix
+        max_lag (int, optional): largest lag (in samples) to return.
+        By default, all lags of "same" mode are returned, like
+        cross_correlation
+        reduce (str, optional): if "peak", return the lag and value of
+        the peak (largest absolute value) of every correlation,
+        instead of the correlations themselves
+        n_jobs (int, optional): number of threads to use for FFTs.
+        None uses all cores
+
+    Returns:
+        if reduce is None:
+            c: np.ndarray of shape (number of lags, number of pairs).
+            Lags go from -max_lag to max_lag (or, by default, from
+            -(n // 2) to n - n // 2 - 1), and pair k is the pair of
+            channels (i[k], j[k]) = np.triu_indices(number of channels).
+            c[:, k] is cross_correlation(X[:, i[k]], X[:, j[k]]) with a
+            single chunk the length of the signal
+        if reduce is "peak":
+            peak_lag: (channels, channels) matrix of lags of the peaks,
+            where peak_lag[i, j] = -peak_lag[j, i]
+            peak_value: (channels, channels) matrix of peak correlations
+    """
+
+    import scipy.fft
+
+    assert X.ndim == 2, "X should be a (samples, channels) matrix"
+    assert reduce in (None, "peak"), f"Unknown reduce: {reduce}"
+
+    if np.any(np.isnan(X)):
+        raise RuntimeError("nans in X")
+
+    n, n_channels = X.shape
+    if max_lag is None:
+        lags = np.arange(n) - n // 2
+    else:
+        assert 0 <= max_lag < n, "max_lag should be less than n"
+        lags = np.arange(-max_lag, max_lag + 1)
+
+    workers = -1 if n_jobs is None else n_jobs
+
+    fft_size = _fft_size(n, np.abs(lags).max())
+    spectra = scipy.fft.rfft(
+        _zscore_rows(X.T), fft_size, axis=1, workers=workers
+    )
+    conj_spectra = np.conj(spectra)
+
+    rows, cols = np.triu_indices(n_channels)
+
+    if reduce is None:
+        c = np.empty((len(lags), len(rows)))
+    else:
+        peak_lag = np.zeros((n_channels, n_channels), dtype=int)
+        peak_value = np.zeros((n_channels, n_channels))
+
+    block = max(1, _XCORR_BLOCK_BYTES // (fft_size * 16))
+    pair = 0
+
+    for i in range(n_channels):
+        for first in range(i, n_channels, block):
+            last = min(first + block, n_channels)
+
+            full = scipy.fft.irfft(
+                spectra[i] * conj_spectra[first:last],
+                fft_size,
+                axis=1,
+                workers=workers,
+            )
+            corr = full[:, lags % fft_size] / n
+
+            if reduce is None:
+                c[:, pair : pair + last - first] = corr.T
+            else:
+                peak = np.argmax(np.abs(corr), axis=1)
+                value = corr[np.arange(last - first), peak]
+                peak_value[i, first:last] = value
+                peak_value[first:last, i] = value
+                peak_lag[i, first:last] = lags[peak]
+                peak_lag[first:last, i] = -lags[peak]
+
+            pair += last - first
+
+    if reduce is None:
+        return c
+    return peak_lag, peak_value
@@ -3,12 +3,21 @@ This module contains functions that mimic some of MATLAB's builtins
 for easier transition to python land
 """
 
-import multiprocessing
+import time
 import warnings
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
 import numpy as np
 
+from pycore.parallel import (
+    chunk_edges,
+    from_shared_memory,
+    get_pool,
+    pool_settings,
+    release_shared_memory,
+    to_shared_memory,
+)
 from pycore.validate import (
     check_all_arrays_same_shape,
     check_axis,
@@ -31,12 +40,25 @@ def chunk_index(x: np.array, chunk_size: int) -> np.array:
     return np.floor(np.arange(len(x)) / chunk_size).astype(int)
 
 
+# first_nonzero/last_nonzero read arrays in blocks of about this
+# many bytes, so that they stay in cache and can stop early
+_NONZERO_BLOCK_BYTES = 1 << 20
+
+# blocks are never shorter than this along axis, however many lanes
+# there are, so that each numpy call does a useful amount of work
+_NONZERO_MIN_BLOCK = 1 << 12
+
+
 def first_nonzero(arr: np.array, axis: int = 0, invalid_val: float = -1):
     """
     find the index of the first non-zero element in an array
 
+    the array is read in small blocks along axis, stopping as soon as
+    every lane has a nonzero element, so memmapped arrays are only
+    read as far as needed
+
     Args:
-        arr (np.array): some array
+        arr (np.array): some array, or np.memmap
         axis (TYPE): axis to operate on
         invalid_val (-1): if there are no nonzero values, then use
         this to indicate
@@ -45,16 +67,19 @@ def first_nonzero(arr: np.array, axis: int = 0, invalid_val: float = -1):
         array of integers of positions in array
     """
 
-    mask = arr != 0
-    return np.where(mask.any(axis=axis), mask.argmax(axis=axis), invalid_val)
+    first, _, found = _nonzero_bounds(arr, axis, find_first=True)
+    return np.where(found, first, invalid_val)
 
 
 def last_nonzero(arr: np.array, axis=0, invalid_val: float = -1):
     """
     find the index of the last non-zero element in an array
 
+    the array is read in small blocks along axis, starting from the
+    end, and stopping as soon as every lane has a nonzero element
+
     Args:
-        arr (np.array): some array
+        arr (np.array): some array, or np.memmap
         axis (TYPE): axis to operate on
         invalid_val (-1): if there are no nonzero values, then use
         this to indicate
@@ -62,17 +87,267 @@ def last_nonzero(arr: np.array, axis=0, invalid_val: float = -1):
     Returns:
         array of integers of positions in array
     """
-    mask = arr != 0
-    val = arr.shape[axis] - np.flip(mask, axis=axis).argmax(axis=axis) - 1
-    return np.where(mask.any(axis=axis), val, invalid_val)
+
+    _, last, found = _nonzero_bounds(arr, axis, find_last=True)
+    return np.where(found, last, invalid_val)
 
 
-def parfor(func: Callable, args, operate_on_columns: bool = True):
+def nonzero_bounds(arr: np.array, axis: int = 0, invalid_val: float = -1):
+    """
+    find the indices of the first and the last non-zero element in an
+    array, reading every element at most once
+
+    blocks are read from both ends of axis towards the middle, and
+    reading stops once every lane has a nonzero element at both ends
+
+    Args:
+        arr (np.array): some array, or np.memmap
+        axis (int): axis to operate on
+        invalid_val (-1): if there are no nonzero values, then use
+        this to indicate
+
+    Returns:
+        first, last: arrays of integers, the same as first_nonzero
+        and last_nonzero
+    """
+
+    first, last, found = _nonzero_bounds(
+        arr, axis, find_first=True, find_last=True
+    )
+    return (
+        np.where(found, first, invalid_val),
+        np.where(found, last, invalid_val),
+    )
+
+
+def _nonzero_bounds(
+    arr, axis: int, *, find_first: bool = False, find_last: bool = False
+):
+    """scans blocks of arr along axis, from the front (for find_first)
+    and/or from the back (for find_last), until every lane is done
+
+    Returns:
+        first, last, found: arrays with one element per lane. first
+        and last are only meaningful where found is True
+    """
+
+    lanes = np.moveaxis(np.asanyarray(arr), axis, -1)
+    n = lanes.shape[-1]
+    shape = lanes.shape[:-1]
+    n_lanes = int(np.prod(shape, dtype=np.int64))
+    block = _NONZERO_BLOCK_BYTES // max(1, n_lanes * lanes.itemsize)
+    block = max(1, min(n, max(_NONZERO_MIN_BLOCK, block)))
+
+    # with many lanes, a block of every lane no longer fits the
+    # budget, so lanes are scanned a group of leading rows at a time
+    row_bytes = n_lanes // max(1, shape[0]) * lanes.itemsize if shape else 0
+    tile = _NONZERO_BLOCK_BYTES // max(1, row_bytes * block)
+    if not shape or tile >= shape[0]:
+        return _scan_nonzero(lanes, block, find_first, find_last)
+
+    first = np.empty(shape, dtype=np.intp)
+    last = np.empty(shape, dtype=np.intp)
+    found = np.empty(shape, dtype=bool)
+    for start in range(0, shape[0], max(1, tile)):
+        stop = start + max(1, tile)
+        first[start:stop], last[start:stop], found[start:stop] = _scan_nonzero(
+            lanes[start:stop], block, find_first, find_last
+        )
+    return first, last, found
+
+
+def _scan_nonzero(lanes, block: int, find_first: bool, find_last: bool):
+    """the scan of _nonzero_bounds, on lanes along the last axis, in
+    blocks of block elements"""
+
+    n = lanes.shape[-1]
+    shape = lanes.shape[:-1]
+
+    # first/last are the min/max over blocks read so far. They are
+    # final once a hit is seen while reading from that end
+    first = np.full(shape, n, dtype=np.intp)
+    last = np.full(shape, -1, dtype=np.intp)
+    first_done = np.full(shape, not find_first)
+    last_done = np.full(shape, not find_last)
+
+    front, back = 0, n
+    while front < back and not (first_done.all() and last_done.all()):
+        if find_first:
+            stop = min(front + block, back)
+            mask = lanes[..., front:stop] != 0
+            hit = mask.any(axis=-1)
+            first = np.minimum(
+                first, np.where(hit, front + mask.argmax(axis=-1), n)
+            )
+            if find_last and hit.any():
+                block_last = stop - 1 - mask[..., ::-1].argmax(axis=-1)
+                last = np.maximum(last, np.where(hit, block_last, -1))
+            first_done |= hit
+            front = stop
+
+        if find_last and front < back:
+            start = max(back - block, front)
+            mask = lanes[..., start:back] != 0
+            hit = mask.any(axis=-1)
+            block_last = back - 1 - mask[..., ::-1].argmax(axis=-1)
+            last = np.maximum(last, np.where(hit, block_last, -1))
+            if find_first and hit.any():
+                block_first = start + mask.argmax(axis=-1)
+                first = np.minimum(first, np.where(hit, block_first, n))
+            last_done |= hit
+            back = start
+
+    found = first < n if find_first else last >= 0
+    return first, last, found
+
+
+# run-length functions read arrays in chunks of this many elements
+_RUN_CHUNK_SIZE = 1 << 22
+
+# dtype of the table returned by find_runs
+RUN_DTYPE = np.dtype(
+    [("start", np.intp), ("stop", np.intp), ("length", np.intp)]
+)
+
+
+def run_length_encode(arr: np.array, *, chunk_size: int = _RUN_CHUNK_SIZE):
+    """
+    compresses a 1-D array into runs of repeated values
+
+    the array is read chunk_size elements at a time, and runs that
+    cross chunk boundaries are joined, so this works on memmapped
+    arrays that don't fit in memory. NaNs are treated as equal to
+    eachother.
+
+    Args:
+        arr (np.array): 1-D array, or np.memmap
+        chunk_size (int, optional): number of elements read at once
+
+    Returns:
+        values: value of every run
+        lengths: length of every run
+    """
+
+    arr = np.asanyarray(arr)
+    assert arr.ndim == 1, "arr should be 1-D"
+
+    starts = []
+    for offset, chunk, previous in _run_chunks(arr, chunk_size):
+        if previous is None:
+            changed = np.concatenate(([True], _differs(chunk[1:], chunk[:-1])))
+        else:
+            changed = _differs(chunk, np.concatenate(([previous], chunk[:-1])))
+        starts.append(np.flatnonzero(changed) + offset)
+
+    starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.intp)
+    lengths = np.diff(np.append(starts, len(arr)))
+    return np.asarray(arr[starts]), lengths
+
+
+def run_length_decode(values: np.array, lengths: np.array) -> np.array:
+    """
+    inverse of run_length_encode
+
+    Args:
+        values (np.array): value of every run
+        lengths (np.array): length of every run
+
+    Returns:
+        np.array with values[i] repeated lengths[i] times
+    """
+
+    return np.repeat(values, lengths)
+
+
+def find_runs(trace: np.array, *, chunk_size: int = _RUN_CHUNK_SIZE):
+    """
+    finds every run of nonzero elements in a 1-D trace, like
+    MATLAB's bwlabel/regionprops on 1-D images
+
+    the trace is read chunk_size elements at a time, and runs that
+    cross chunk boundaries are joined, so this works on memmapped
+    traces that don't fit in memory
+
+    Args:
+        trace (np.array): 1-D array, or np.memmap
+        chunk_size (int, optional): number of elements read at once
+
+    Returns:
+        structured np.array (dtype RUN_DTYPE) with one row per run,
+        and fields start, stop (exclusive) and length. Use
+        pd.DataFrame(runs) to get a table
+    """
+
+    trace = np.asanyarray(trace)
+    assert trace.ndim == 1, "trace should be 1-D"
+
+    starts = []
+    stops = []
+    for offset, chunk, previous in _run_chunks(trace, chunk_size):
+        # pad with the state before the chunk, so that runs that
+        # continue from the last chunk don't start again
+        padded = np.empty(len(chunk) + 1, dtype=np.int8)
+        padded[0] = previous is not None and previous != 0
+        np.not_equal(chunk, 0, out=padded[1:], casting="unsafe")
+        edges = np.diff(padded)
+        starts.append(np.flatnonzero(edges == 1) + offset)
+        stops.append(np.flatnonzero(edges == -1) + offset)
+
+    if len(trace) and trace[-1] != 0:
+        stops.append([len(trace)])
+
+    runs = np.zeros(sum(len(s) for s in starts), dtype=RUN_DTYPE)
+    if len(runs):
+        runs["start"] = np.concatenate(starts)
+        runs["stop"] = np.concatenate(stops)
+        runs["length"] = runs["stop"] - runs["start"]
+    return runs
+
+
+def _run_chunks(arr: np.array, chunk_size: int):
+    """yields (offset, chunk, last element of the previous chunk),
+    with chunks read into memory one at a time"""
+
+    assert chunk_size > 0, "chunk_size should be positive"
+
+    previous = None
+    for offset in range(0, len(arr), chunk_size):
+        chunk = np.asarray(arr[offset : offset + chunk_size])
+        yield offset, chunk, previous
+        previous = chunk[-1]
+
+
+def _differs(a: np.array, b: np.array) -> np.array:
+    """a != b, but with NaNs equal to eachother"""
+
+    changed = a != b
+    if np.issubdtype(a.dtype, np.inexact):
+        changed &= ~(np.isnan(a) & np.isnan(b))
+    return changed
+
+
+# parfor(backend="auto") runs serially if the whole job is
+# estimated to take less than this many seconds
+_PARFOR_SERIAL_SECONDS = 0.05
+
+# rough speed at which inputs are copied into shared memory
+_PARFOR_COPY_BYTES_PER_SECOND = 1e9
+
+
+def parfor(
+    func: Callable,
+    args,
+    operate_on_columns: bool = True,
+    *,
+    shared_memory: bool = True,
+    backend: str = "process",
+):
     """
     auto parallelization of numpy arrays
 
     Automatically apply function to columns/rows
-    of numpy array using multiprocessing.Pool
+    of numpy array using pycore's pool of worker processes
+    (see pycore.parallel.configure_pool and worker_pool)
 
     This is an attempt to replicate the simplicity of
     parfor in MATLAB. Basically this is to allow something
@@ -83,36 +358,91 @@ def parfor(func: Callable, args, operate_on_columns: bool = True):
         X(i,:) = func(Y(i,:));
     end
 
+    By default, the arrays in args are placed in shared memory once,
+    and every process is only told which range of columns/rows
+    to work on. Results are written straight into a shared output
+    array, whose shape and dtype are those of the output on the first
+    column/row. Outputs that don't fit in it without being cast to a
+    narrower dtype or broadcast (e.g. a float after an int first
+    output) are sent back instead, and the result is the same as with
+    shared_memory=False. If the first output isn't numeric, the old
+    behavior (sending copies of every column/row to the workers) is
+    used instead.
+
+    backend picks where func runs:
+
+    - "process": on the pool of worker processes
+    - "thread": on threads, which work on views of args without
+    copying anything. Best for funcs that release the GIL (most
+    numpy/scipy functions on large arrays)
+    - "serial": in a plain loop in this process
+    - "auto": calls func on a few columns/rows, and picks serial if
+    the whole job is quick, thread if running two calls on two
+    threads is about as fast as one call (i.e., func releases the
+    GIL), and otherwise process, unless copying args into shared
+    memory would cost more than it saves
+
     Args:
         func (function): Description
         args (TYPE): Description
         operate_on_columns (bool, optional): Description
+        shared_memory (bool, optional): pass data to workers using
+        shared memory instead of pickling every column/row
+        backend (str, optional): "process", "thread", "serial" or "auto"
 
     Returns:
         TYPE: Description
     """
 
     assert callable(func), "Expected first argument to be a function"
+    assert backend in (
+        "process",
+        "thread",
+        "serial",
+        "auto",
+    ), f"Unknown backend: {backend}"
     check_all_arrays_same_shape(args)
 
-    n_procs = multiprocessing.cpu_count()
-
     if operate_on_columns:
-        n_col = args[0].shape[1]
-        n_args = len(args)
-        func_data = [
-            [args[i][:, col] for i in range(n_args)] for col in range(n_col)
-        ]
-
+        n_items = args[0].shape[1]
     else:
-        n_rows = args[0].shape[0]
-        n_args = len(args)
-        func_data = [
-            [args[i][row, :] for i in range(n_args)] for row in range(n_rows)
-        ]
+        n_items = args[0].shape[0]
+
+    # outputs of func on the first few columns/rows, which are kept
+    # rather than computed again
+    done = []
+    if n_items > 0 and (shared_memory or backend != "process"):
+        tic = time.perf_counter()
+        done.append(_parfor_call(func, args, 0, operate_on_columns))
+        seconds_per_item = time.perf_counter() - tic
+
+        if backend == "auto":
+            backend, tried = _choose_parfor_backend(
+                func, args, operate_on_columns, n_items, seconds_per_item
+            )
+            done += tried
+
+        if backend != "process":
+            n_threads = 1 if backend == "serial" else pool_settings().n_workers
+            return _parfor_threads(
+                func, args, operate_on_columns, done, n_items, n_threads
+            )
 
-    with multiprocessing.Pool(n_procs) as p:
-        result = p.starmap(func, func_data)
+        if shared_memory and not np.asarray(done[0]).dtype.hasobject:
+            return _parfor_shared(
+                func, args, operate_on_columns, done, n_items
+            )
+
+    func_data = [
+        [_parfor_item(arg, i, operate_on_columns) for arg in args]
+        for i in range(len(done), n_items)
+    ]
+
+    result = done
+    if func_data or not done:
+        result = result + get_pool(func=func).starmap(
+            func, func_data, chunksize=pool_settings().chunk_size
+        )
 
     if operate_on_columns:
         result = np.array(result).transpose()
@@ -122,6 +452,204 @@ def parfor(func: Callable, args, operate_on_columns: bool = True):
     return result
 
 
+def _choose_parfor_backend(
+    func, args, operate_on_columns, n_items, seconds_per_item
+) -> tuple:
+    """picks a parfor backend based on how long func takes to run
+
+    Returns:
+        backend, and the outputs of func on the columns/rows after
+        the first that were run to time it
+    """
+
+    n_workers = pool_settings().n_workers
+    total_seconds = seconds_per_item * n_items
+
+    if total_seconds < _PARFOR_SERIAL_SECONDS or n_workers == 1:
+        return "serial", []
+
+    tried = []
+    if n_items >= 3:
+        # if func releases the GIL, two calls on two threads take
+        # about as long as one call
+        def call(i):
+            return _parfor_call(func, args, i, operate_on_columns)
+
+        with ThreadPoolExecutor(2) as executor:
+            tic = time.perf_counter()
+            tried = list(executor.map(call, [1, 2]))
+            seconds_per_pair = time.perf_counter() - tic
+
+        if seconds_per_pair < 1.5 * seconds_per_item:
+            return "thread", tried
+
+    copy_seconds = (
+        sum(arg.nbytes for arg in args) / _PARFOR_COPY_BYTES_PER_SECOND
+    )
+    if copy_seconds > total_seconds * (1 - 1 / n_workers):
+        return "serial", tried
+
+    return "process", tried
+
+
+def _parfor_threads(func, args, operate_on_columns, done, n_items, n_threads):
+    """parfor on threads (or serially, if n_threads is 1), working
+    on views of args and writing into a preallocated output
+
+    done are the outputs of func on the first columns/rows. The first
+    one sets the shape and dtype of the output
+    """
+
+    def call(i):
+        return _parfor_call(func, args, i, operate_on_columns)
+
+    first = np.asarray(done[0])
+    if first.dtype.hasobject:
+        # can't preallocate outputs, so collect them
+        result = np.array(done + [call(i) for i in range(len(done), n_items)])
+
+    else:
+        out = np.empty((n_items,) + first.shape, dtype=first.dtype)
+        misfits = {}
+
+        def store(i, output):
+            if _fits(output, out):
+                out[i] = output
+            else:
+                misfits[i] = output
+
+        def run(start, stop):
+            for i in range(start, stop):
+                store(i, call(i))
+
+        for i, output in enumerate(done):
+            store(i, output)
+
+        if n_threads == 1:
+            run(len(done), n_items)
+        else:
+            edges = chunk_edges(n_items, start=len(done))
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(run, edges[:-1], edges[1:]))
+
+        result = _with_misfits(out, misfits)
+
+    if operate_on_columns:
+        return result.transpose()
+    return result
+
+
+def _parfor_call(func, args, i: int, operate_on_columns: bool):
+    """func of the i-th columns (or rows) of args"""
+    return func(*[_parfor_item(arg, i, operate_on_columns) for arg in args])
+
+
+def _parfor_item(arg: np.ndarray, i: int, operate_on_columns: bool):
+    """the i-th column or row of arg"""
+    if operate_on_columns:
+        return arg[:, i]
+    return arg[i, :]
+
+
+def _parfor_shared(func, args, operate_on_columns, done, n_items):
+    """parfor, using shared memory for inputs and outputs
+
+    done are the outputs of func on the first columns/rows. The first
+    one sets the shape and dtype of the output
+    """
+
+    first = np.asarray(done[0])
+
+    shms = []
+    try:
+        in_specs = []
+        for arg in args:
+            shm, _, spec = to_shared_memory(arg.shape, arg.dtype, fill=arg)
+            shms.append(shm)
+            in_specs.append(spec)
+
+        shm, out, out_spec = to_shared_memory(
+            (n_items,) + first.shape, first.dtype
+        )
+        shms.append(shm)
+
+        misfits = {}
+        for i, output in enumerate(done):
+            if _fits(output, out):
+                out[i] = output
+            else:
+                misfits[i] = output
+
+        pool = get_pool(func=func)
+        edges = chunk_edges(n_items, start=len(done))
+        tasks = [
+            (func, in_specs, out_spec, operate_on_columns, start, stop)
+            for start, stop in zip(edges[:-1], edges[1:])
+        ]
+
+        for batch_misfits in pool.starmap(_parfor_batch, tasks):
+            misfits.update(batch_misfits)
+
+        result = np.array(_with_misfits(out, misfits))
+        if operate_on_columns:
+            result = result.transpose()
+
+    finally:
+        out = None
+        for shm in shms:
+            release_shared_memory(shm)
+
+    return result
+
+
+def _parfor_batch(func, in_specs, out_spec, operate_on_columns, start, stop):
+    """runs in a worker process. Writes func of columns/rows
+    start to stop of the inputs into the output, all in
+    shared memory
+
+    Returns:
+        dict of the outputs that don't fit in the output array (see
+        _fits), by index, which are sent back instead
+    """
+
+    shms, inputs = zip(*[from_shared_memory(spec) for spec in in_specs])
+    out_shm, out = from_shared_memory(out_spec)
+    misfits = {}
+    try:
+        for i in range(start, stop):
+            output = _parfor_call(func, inputs, i, operate_on_columns)
+            if _fits(output, out):
+                out[i] = output
+            else:
+                misfits[i] = output
+    finally:
+        inputs = out = None
+        for shm in shms + (out_shm,):
+            shm.close()
+    return misfits
+
+
+def _fits(output, out: np.ndarray) -> bool:
+    """checks that output can be stored as an item of out as is,
+    without being cast to a narrower dtype or broadcast"""
+
+    output = np.asarray(output)
+    return output.shape == out.shape[1:] and np.can_cast(
+        output.dtype, out.dtype, "safe"
+    )
+
+
+def _with_misfits(out: np.ndarray, misfits: dict) -> np.ndarray:
+    """out, or if some outputs didn't fit in it, the array numpy makes
+    of all outputs, as if they had never been put in out"""
+
+    if not misfits:
+        return out
+    return np.array(
+        [misfits[i] if i in misfits else out[i] for i in range(len(out))]
+    )
+
+
 def _methods_and_properties(thing, ignore_internal=True):
     """returns methods and properties of an object
 
@@ -263,14 +791,64 @@ def Vector(N, *, dtype="float64", fill=None):
     return x
 
 
+# reducers that splitapply can compute for all groups at once.
+# maps the function (or its name) to the name of the reducer
+_SPLITAPPLY_REDUCERS = {
+    np.nanmean: "nanmean",
+    np.nansum: "nansum",
+    np.nanmax: "nanmax",
+    np.nanmin: "nanmin",
+    np.nanstd: "nanstd",
+    np.median: "median",
+    np.nanmedian: "nanmedian",
+    "nanmean": "nanmean",
+    "nansum": "nansum",
+    "nanmax": "nanmax",
+    "nanmin": "nanmin",
+    "nanstd": "nanstd",
+    "median": "median",
+    "nanmedian": "nanmedian",
+    "count": "count",
+}
+
+
 def splitapply(
-    data: np.array, *, groups: np.array, func=np.nanmean
+    data: np.array,
+    *,
+    groups: np.array,
+    func=np.nanmean,
+    n_jobs: Optional[int] = 1,
 ) -> np.array:
     """equivalent to MATLAB's splitapply
 
+    groups are found by sorting groups once, so that every group
+    is a contiguous slice of the (sorted) data. The following
+    reducers are computed for all groups at once, without calling
+    func for every group:
+
+    np.nanmean, np.nansum, np.nanmax, np.nanmin, np.nanstd,
+    np.median, np.nanmedian
+
+    these can also be specified by name, as can "count", which
+    counts the non-NaN elements in each group. Any other func is
+    called once per group, on a slice of the sorted data.
+
+    If n_jobs isn't 1, these calls are split across pycore's pool of
+    worker processes (see pycore.parallel.configure_pool).
+    The sorted data is placed in shared memory once, and every
+    process works through a batch of groups with roughly the same
+    number of rows. func must be picklable (so no lambdas), and
+    should not depend on modifying its input.
+
     Args:
         data (np.ndarray): 2D or 1D matrix
         groups (np.ndarray): vector as long as data
+        func (callable or str): applied to the data in each group
+        n_jobs (int, optional): number of processes to use for
+        funcs that aren't built-in reducers. The data is split into
+        n_jobs batches that run on the shared pool, which is not
+        restarted for a different n_jobs. None uses the whole pool
+        (all cores by default, see configure_pool)
 
     Returns:
         result: np.ndarray the same size as unique(groups)
@@ -281,38 +859,282 @@ def splitapply(
     check_type(groups, np.ndarray)
     check_first_dimension_size((data, groups))
 
-    data = np.copy(data)
+    unique_values, order, starts, counts = _group_boundaries(groups)
+    stops = starts + counts
 
-    unique_values = np.unique(groups)
+    reducer = _SPLITAPPLY_REDUCERS.get(func) if _is_hashable(func) else None
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
-        # apply the func to the first chunk of data to figure
-        # out the size of the output matrix
-        temp = func(data[groups == groups[0]])
+        if reducer is not None:
+            sorted_data = data if order is None else data[order]
+            return _reduce_groups(reducer, sorted_data, starts, counts)
 
-        if type(temp) == float:
-            temp = np.float64(temp)
+        if isinstance(func, str):
+            raise ValueError(f"Unknown reducer: {func}")
 
-        temp_shape = temp.shape
+        if (n_jobs is None or n_jobs > 1) and len(unique_values) > 1:
+            outputs = _splitapply_parallel(
+                data, order, func, starts, stops, n_jobs
+            )
+        else:
+            # sorting copies the data, otherwise copy it here, so
+            # that func can't modify the data we were given
+            sorted_data = np.copy(data) if order is None else data[order]
+            outputs = (
+                func(sorted_data[start:stop])
+                for start, stop in zip(starts, stops)
+            )
 
-        if len(temp_shape) == 0:
-            # output of func is scalar
-            result = np.full(unique_values.shape, np.nan)
+        result = None
+        for i, output in enumerate(outputs):
+            output = np.asarray(output)
 
-            for i, value in enumerate(unique_values):
-                result[i] = func(data[groups == value])
+            if result is None:
+                # use the output of the first group to figure
+                # out the size of the output matrix
+                if output.ndim > 1:
+                    raise Exception(
+                        "func returns something more complex than a vector. "
+                    )
+                result = np.full((len(unique_values),) + output.shape, np.nan)
 
-        elif len(temp_shape) == 1:
-            # output of func is a vector, so we should return a matrix
-            result = np.full((unique_values.shape, temp_shape[0]), np.nan)
+            result[i] = output
 
-            for i, value in enumerate(unique_values):
-                result[i, :] = func(data[groups == value])
+    return result
+
+
+def _splitapply_parallel(data, order, func, starts, stops, n_jobs):
+    """calls func on every group using a pool of processes
+
+    the data is sorted straight into shared memory, and every
+    process is given a batch of (start, stop) pairs to work on
+
+    Returns:
+        list of outputs of func, one for every group, in order
+    """
+
+    pool = get_pool(func=func)
+    settings = pool_settings()
+    if n_jobs is not None:
+        # the running pool is reused whatever its size, and at most
+        # n_jobs of its processes are kept busy
+        n_batches = n_jobs
+    elif settings.chunk_size is None:
+        n_batches = settings.n_workers * 4
+    else:
+        n_batches = int(np.ceil(len(starts) / settings.chunk_size))
+
+    shm, shared, spec = to_shared_memory(data.shape, data.dtype)
+    try:
+        if order is None:
+            shared[...] = data
         else:
-            raise Exception(
-                "func returns something more complex than a vector. "
-            )
+            np.take(data, order, axis=0, out=shared)
 
-    return result
+        # drop our view, so that shm can be closed
+        shared = None
+
+        tasks = [
+            (spec, func, starts[first:last], stops[first:last])
+            for first, last in _balanced_batches(stops, n_batches)
+        ]
+
+        batches = pool.starmap(_splitapply_batch, tasks)
+
+    finally:
+        shared = None
+        release_shared_memory(shm)
+
+    return [output for batch in batches for output in batch]
+
+
+def _balanced_batches(stops: np.ndarray, n_batches: int) -> list:
+    """splits groups into (at most) n_batches contiguous batches
+    that have roughly the same number of rows
+
+    Args:
+        stops (np.ndarray): where each group ends, in sorted order
+        n_batches (int): number of batches to make
+
+    Returns:
+        list of (first, last) group indices of every batch
+    """
+
+    n_groups = len(stops)
+    targets = stops[-1] * np.arange(1, n_batches) / n_batches
+    edges = np.searchsorted(stops, targets) + 1
+    edges = np.unique(np.concatenate(([0], edges, [n_groups])))
+    edges = edges[edges <= n_groups]
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _splitapply_batch(spec: dict, func, starts, stops) -> list:
+    """runs in a worker process. Calls func on a batch of groups
+    of the data in shared memory"""
+
+    shm, data = from_shared_memory(spec)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+
+            # outputs are copied, because they may be views into
+            # shared memory, which is about to be closed
+            return [
+                np.array(func(data[start:stop]))
+                for start, stop in zip(starts, stops)
+            ]
+    finally:
+        data = None
+        shm.close()
+
+
+def _is_hashable(thing) -> bool:
+    """checks if thing can be used as a dictionary key"""
+    try:
+        hash(thing)
+    except TypeError:
+        return False
+    return True
+
+
+def _group_boundaries(groups: np.ndarray):
+    """sorts groups once, and finds where each group starts
+
+    Args:
+        groups (np.ndarray): vector of group labels
+
+    Returns:
+        unique_values: sorted unique values of groups, like np.unique
+        order: indices that sort groups (stably), or None if groups
+        is already sorted
+        starts: index (in sorted order) where each group starts
+        counts: number of elements in each group
+    """
+
+    if groups.shape[0] > 1 and np.all(groups[1:] >= groups[:-1]):
+        order = None
+        sorted_groups = groups
+    else:
+        order = _stable_argsort(groups)
+        sorted_groups = groups[order]
+
+    is_new = np.empty(sorted_groups.shape[0], dtype=bool)
+    is_new[:1] = True
+    is_new[1:] = sorted_groups[1:] != sorted_groups[:-1]
+
+    if sorted_groups.dtype.kind in "fc":
+        # NaNs are sorted to the end, and are all one group,
+        # like in np.unique
+        nans = np.isnan(sorted_groups)
+        is_new[1:] &= ~(nans[1:] & nans[:-1])
+
+    starts = np.flatnonzero(is_new)
+    counts = np.diff(np.append(starts, sorted_groups.shape[0]))
+
+    return sorted_groups[starts], order, starts, counts
+
+
+def _stable_argsort(x: np.ndarray) -> np.ndarray:
+    """stable argsort of a vector
+
+    np.argsort(kind="stable") is slow for large integer arrays, so
+    integers are instead packed together with their position into a
+    single int64 key, which np.sort sorts much faster
+    """
+
+    n = x.shape[0]
+    if x.dtype.kind in "iub" and n > 0:
+        lo = int(x.min())
+        hi = int(x.max())
+        # uint64 values from 2**63 up don't fit in an int64
+        if hi < 2**63 and (hi - lo + 1) * n < 2**62:
+            key = (x.astype(np.int64) - lo) * n + np.arange(n)
+            key.sort()
+            return key % n
+
+    return np.argsort(x, kind="stable")
+
+
+def _reduce_groups(
+    reducer: str,
+    sorted_data: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+) -> np.ndarray:
+    """computes a reducer over all elements of each group at once
+
+    every group is a contiguous block of rows of sorted_data,
+    starting at starts and counts rows long. Like calling the
+    reducer on data[groups == value], all elements of the rows
+    are reduced to a single number
+    """
+
+    n_rows = sorted_data.shape[0]
+    values = sorted_data.reshape(n_rows, -1).astype(np.float64, copy=False)
+    valid = ~np.isnan(values)
+
+    # number of non-nan elements in each group
+    count = np.add.reduceat(valid.sum(axis=1), starts).astype(np.float64)
+
+    if reducer == "count":
+        return count
+
+    if reducer in ("nanmax", "nanmin"):
+        ufunc = np.fmax if reducer == "nanmax" else np.fmin
+        return ufunc.reduceat(ufunc.reduce(values, axis=1), starts)
+
+    if reducer in ("median", "nanmedian"):
+        return _median_groups(
+            values, starts, counts, ignore_nan=reducer == "nanmedian"
+        )
+
+    zeroed = np.where(valid, values, 0)
+    total = np.add.reduceat(zeroed.sum(axis=1), starts)
+
+    if reducer == "nansum":
+        return total
+
+    mean = total / count
+    if reducer == "nanmean":
+        return mean
+
+    # nanstd, computed in two passes for numerical stability
+    row_mean = np.repeat(mean, counts)[:, np.newaxis]
+    deviations = np.where(valid, values - row_mean, 0)
+    sum_sq = np.add.reduceat((deviations**2).sum(axis=1), starts)
+    return np.sqrt(sum_sq / count)
+
+
+def _median_groups(
+    values: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    *,
+    ignore_nan: bool,
+) -> np.ndarray:
+    """median of every group, by sorting all elements once within
+    their groups. NaNs are sorted to the end of each group"""
+
+    n_cols = values.shape[1]
+    labels = np.repeat(np.arange(len(starts)), counts * n_cols)
+    flat = values.reshape(-1)
+    flat = flat[np.lexsort((flat, labels))]
+
+    first = starts * n_cols
+    n_total = counts * n_cols
+    n_valid = np.add.reduceat(~np.isnan(flat), first)
+
+    n = n_valid if ignore_nan else n_total
+    has_values = n > 0
+    lo = first + np.maximum(n - 1, 0) // 2
+    hi = first + n // 2
+    hi = np.where(has_values, hi, first)
+
+    median = (flat[lo] + flat[hi]) / 2
+    median[~has_values] = np.nan
+    if not ignore_nan:
+        median[n_valid < n_total] = np.nan
+    return median
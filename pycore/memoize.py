@@ -0,0 +1,247 @@
+"""content-addressed, on-disk memoization of function results
+
+results are stored in a cache folder, in a file named by a hash
+of the function's source code and all its arguments. This means that
+calling a function again with identical inputs reads the result from
+disk instead of recomputing it, and that editing the function
+automatically invalidates old results.
+"""
+
+import functools
+import inspect
+import os
+import pickle
+from typing import Callable, Optional
+
+import numpy as np
+
+from pycore.core import hash_dict, is_pandas, md5hash
+from pycore.filetools import atomic_write
+
+# extensions of files that results can be stored in
+_EXTENSIONS = (".npy", ".parquet", ".pkl")
+
+
+def memoize(
+    func: Optional[Callable] = None,
+    *,
+    cache_dir: str = ".pycore_cache",
+    max_size: Optional[int] = None,
+    max_entries: Optional[int] = None,
+    backend: Optional[str] = None,
+):
+    """
+    decorator that caches the results of a function on disk
+
+    can be used bare (@memoize) or with arguments
+    (@memoize(cache_dir="...", max_size=10e9)).
+
+    The cache key is derived from the function's source code, all
+    positional arguments (using md5hash) and all keyword arguments
+    (using hash_dict), so all arguments must be hashable by md5hash.
+    Results are stored by type: numpy arrays as .npy,
+    DataFrames as .parquet (if pyarrow or fastparquet are
+    installed) and everything else as a pickle. Files are written
+    atomically, so concurrent processes never see partial results.
+
+    If max_size or max_entries are given, least recently used results
+    are deleted from cache_dir whenever the limits are exceeded.
+
+    Args:
+        func (Callable): function to memoize
+        cache_dir (str, optional): folder to store results in
+        max_size (int, optional): maximum size of cache_dir, in bytes
+        max_entries (int, optional): maximum number of stored results
+        backend (str, optional): hash backend, see md5hash
+
+    Returns:
+        wrapped function
+    """
+
+    def decorator(func):
+        source_hash = _source_hash(func, backend)
+
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            key = _cache_key(func, source_hash, args, kwargs, backend)
+
+            path = _find_result(cache_dir, key)
+            if path is not None:
+                # mark as recently used
+                os.utime(path)
+                return _load_result(path)
+
+            result = func(*args, **kwargs)
+
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_result(result, os.path.join(cache_dir, key))
+
+            if max_size is not None or max_entries is not None:
+                _evict(
+                    cache_dir,
+                    max_size=max_size,
+                    max_entries=max_entries,
+                )
+
+            return result
+
+        _wrapper.cache_dir = cache_dir
+        return _wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def clear_cache(cache_dir: str = ".pycore_cache") -> None:
+    """
+    deletes all results memoized in some folder
+
+    Args:
+        cache_dir (str, optional): folder used by memoize
+    """
+
+    for path, _, _ in _cached_files(cache_dir):
+        os.remove(path)
+
+
+def _source_hash(func: Callable, backend: Optional[str]) -> str:
+    """hash of the source code of a function. If the source isn't
+    available (e.g. for builtins, or functions defined in a REPL)
+    the compiled bytecode is used instead"""
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = getattr(func, "__code__", None)
+        if code is None:
+            source = func.__qualname__
+        else:
+            source = code.co_code + repr(code.co_consts).encode()
+    return md5hash(source, backend=backend)
+
+
+def _cache_key(
+    func: Callable,
+    source_hash: str,
+    args: tuple,
+    kwargs: dict,
+    backend: Optional[str],
+) -> str:
+    """hash that identifies a call to func with args and kwargs"""
+
+    hashes = [func.__module__, func.__qualname__, source_hash]
+    for arg in args:
+        hashes.append(md5hash(arg, backend=backend))
+    hashes.append(hash_dict(kwargs, backend=backend))
+
+    key = md5hash(hashes, backend=backend)
+
+    # backend prefixes can't be part of file names everywhere
+    return f"{func.__name__}_{key.replace(':', '-')}"
+
+
+def _find_result(cache_dir: str, key: str) -> Optional[str]:
+    """path to the stored result for some key, if it exists"""
+
+    for ext in _EXTENSIONS:
+        path = os.path.join(cache_dir, key + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _load_result(path: str):
+    """reads a stored result from disk"""
+
+    if path.endswith(".npy"):
+        return np.load(path, allow_pickle=False)
+    if path.endswith(".parquet"):
+        import pandas as pd
+
+        return pd.read_parquet(path)
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def _can_write_parquet() -> bool:
+    """checks if pandas has a parquet engine available"""
+    for engine in ("pyarrow", "fastparquet"):
+        try:
+            __import__(engine)
+            return True
+        except ImportError:
+            continue
+    return False
+
+
+def _save_result(result, path_without_ext: str) -> None:
+    """writes result to disk, choosing the format based on its type.
+
+    the result is first written to a temporary file in the same
+    folder, which is then renamed, so that readers never see a
+    partially written file. DataFrames that parquet can't store are
+    pickled instead
+    """
+
+    if is_pandas(result, series=False) and _can_write_parquet():
+        try:
+            with atomic_write(path_without_ext + ".parquet") as file:
+                result.to_parquet(file)
+            return
+        except Exception:
+            # e.g. columns of mixed types, or column labels that
+            # aren't strings. func already ran, so don't lose its result
+            pass
+
+    if isinstance(result, np.ndarray) and not result.dtype.hasobject:
+        with atomic_write(path_without_ext + ".npy") as file:
+            np.save(file, result, allow_pickle=False)
+    else:
+        with atomic_write(path_without_ext + ".pkl") as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _cached_files(cache_dir: str) -> list:
+    """(path, size, mtime) of every stored result in cache_dir"""
+
+    if not os.path.isdir(cache_dir):
+        return []
+
+    files = []
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith(_EXTENSIONS):
+                continue
+            stat = entry.stat()
+            files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def _evict(
+    cache_dir: str,
+    *,
+    max_size: Optional[int],
+    max_entries: Optional[int],
+) -> None:
+    """deletes least recently used results until cache_dir is
+    within the limits"""
+
+    files = sorted(_cached_files(cache_dir), key=lambda file: file[2])
+
+    total_size = sum(size for _, size, _ in files)
+    n_entries = len(files)
+
+    for path, size, _ in files:
+        too_big = max_size is not None and total_size > max_size
+        too_many = max_entries is not None and n_entries > max_entries
+        if not (too_big or too_many):
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # someone else got here first
+            pass
+        total_size -= size
+        n_entries -= 1
@@ -0,0 +1,341 @@
+"""
+helpers for running numpy code on many cores
+
+arrays are handed to worker processes through shared memory, so
+that large inputs are placed in memory once, instead of being
+pickled and copied to every worker.
+
+worker processes are kept in a pool that is started the first time
+it is needed, and reused by every later call to parfor/splitapply,
+so that process startup is only paid once. The pool is shut down
+when python exits.
+"""
+
+import atexit
+import contextlib
+import inspect
+import multiprocessing
+import sys
+import weakref
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+from pycore.core import struct
+
+# options used to start the shared pool, see configure_pool
+_pool_config = struct(n_workers=None, start_method=None, chunk_size=None)
+
+# the shared pool, the settings it was started with, and the
+# functions of __main__ its workers know about (see _main_functions)
+_shared_pool = struct(pool=None, settings=None, main=None)
+
+# pools made by worker_pool, innermost last
+_scoped_pools = []
+
+
+def to_shared_memory(shape, dtype, *, fill=None):
+    """
+    allocates a numpy array in shared memory
+
+    Args:
+        shape (tuple): shape of array
+        dtype: numpy dtype of array
+        fill (np.ndarray, optional): copy this into the array
+
+    Returns:
+        shm: SharedMemory object that owns the memory. The caller
+        must close() and unlink() this when done
+        arr: np.ndarray backed by shm
+        spec: dict that describes the array. Workers can use
+        from_shared_memory(spec) to get at the same array
+    """
+
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+
+    # shared memory can't have zero size
+    shm = shared_memory.SharedMemory(create=True, size=max(n_bytes, 1))
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    if fill is not None:
+        arr[...] = fill
+
+    spec = dict(name=shm.name, shape=tuple(shape), dtype=dtype.str)
+    return shm, arr, spec
+
+
+def from_shared_memory(spec: dict):
+    """
+    attaches to an array made by to_shared_memory
+
+    Args:
+        spec (dict): spec returned by to_shared_memory
+
+    Returns:
+        shm: SharedMemory object. close() this when done, and
+        make sure no views of arr outlive it
+        arr: np.ndarray backed by shared memory
+    """
+
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    arr = np.ndarray(spec["shape"], dtype=spec["dtype"], buffer=shm.buf)
+    return shm, arr
+
+
+def release_shared_memory(shm) -> None:
+    """
+    closes and frees shared memory made by to_shared_memory
+
+    Args:
+        shm: SharedMemory object
+    """
+
+    shm.close()
+    shm.unlink()
+
+
+def _start_pool(settings: struct) -> struct:
+    """starts a pool of processes with some settings
+
+    Returns:
+        struct with pool, settings, and the functions of __main__
+        that forked workers will know about
+    """
+    context = multiprocessing.get_context(settings.start_method)
+    return struct(
+        pool=context.Pool(settings.n_workers),
+        settings=settings,
+        main=_main_functions(settings.start_method),
+    )
+
+
+def _main_functions(start_method: str) -> Optional[dict]:
+    """weak references to the functions defined in __main__ right now
+
+    forked workers get a copy of __main__ as it was when they were
+    started, so they can't unpickle functions defined (or redefined,
+    e.g. by re-running a notebook cell) after that. Other start
+    methods import __main__ from its file, so this is None for them
+    """
+
+    if start_method != "fork":
+        return None
+
+    main = vars(sys.modules["__main__"])
+    return {
+        name: weakref.ref(thing)
+        for name, thing in list(main.items())
+        if inspect.isfunction(thing)
+    }
+
+
+def _knows_function(entry: struct, func) -> bool:
+    """checks if the workers of a pool (entry, made by _start_pool)
+    can unpickle func"""
+
+    if func is None or entry.main is None:
+        return True
+    if getattr(func, "__module__", None) != "__main__":
+        return True
+
+    ref = entry.main.get(getattr(func, "__qualname__", None))
+    return ref is not None and ref() is func
+
+
+def _make_settings(
+    n_workers: Optional[int],
+    start_method: Optional[str],
+    chunk_size: Optional[int],
+) -> struct:
+    """fills in defaults for pool settings"""
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    assert n_workers > 0, "n_workers should be positive"
+
+    if start_method is None:
+        start_method = multiprocessing.get_start_method()
+    assert (
+        start_method in multiprocessing.get_all_start_methods()
+    ), f"{start_method} is not a valid start method on this platform"
+
+    return struct(
+        n_workers=n_workers,
+        start_method=start_method,
+        chunk_size=chunk_size,
+    )
+
+
+def configure_pool(
+    *,
+    n_workers: Optional[int] = None,
+    start_method: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> None:
+    """
+    sets options for the worker pool used by parfor and splitapply
+
+    if the pool is already running, it is shut down, and restarted
+    with the new options the next time it is needed
+
+    Args:
+        n_workers (int, optional): number of processes. Defaults to
+        the number of cores
+        start_method (str, optional): "fork", "forkserver" or "spawn".
+        Defaults to multiprocessing's default
+        chunk_size (int, optional): number of items to send to a
+        worker at once. By default, work is split into ~4 chunks per
+        worker
+    """
+
+    _pool_config.n_workers = n_workers
+    _pool_config.start_method = start_method
+    _pool_config.chunk_size = chunk_size
+    shutdown_pool()
+
+
+def get_pool(*, func=None):
+    """
+    returns the worker pool, starting it if needed
+
+    inside a worker_pool() block, the pool of that block is returned.
+    Otherwise, a shared pool is lazily started using the options set
+    in configure_pool, and kept around for later calls.
+
+    Workers started with "fork" only know the functions of __main__
+    that existed when they were started. If func is one they don't
+    know (e.g. it was defined in a notebook after the pool started),
+    the shared pool is restarted, instead of handing workers a
+    function they can't unpickle.
+
+    Args:
+        func (callable, optional): function that will be sent to
+        the workers
+
+    Returns:
+        multiprocessing.pool.Pool
+    """
+
+    if _scoped_pools:
+        scoped = _scoped_pools[-1]
+        if not _knows_function(scoped, func):
+            raise RuntimeError(
+                f"{func.__qualname__} was defined after the worker_pool() "
+                "it is run on was started, so the forked workers can't "
+                "find it. Define it before the with block, or use "
+                'start_method="spawn"'
+            )
+        return scoped.pool
+
+    settings = _make_settings(
+        _pool_config.n_workers,
+        _pool_config.start_method,
+        _pool_config.chunk_size,
+    )
+
+    if _shared_pool.pool is not None and (
+        _shared_pool.settings != settings
+        or not _knows_function(_shared_pool, func)
+    ):
+        shutdown_pool()
+
+    if _shared_pool.pool is None:
+        _shared_pool.update(_start_pool(settings))
+
+    return _shared_pool.pool
+
+
+def pool_settings() -> struct:
+    """
+    settings of the pool that get_pool() would return
+
+    Returns:
+        struct: with n_workers, start_method and chunk_size
+    """
+
+    if _scoped_pools:
+        return struct(_scoped_pools[-1].settings)
+    if _shared_pool.pool is not None:
+        return struct(_shared_pool.settings)
+    return _make_settings(
+        _pool_config.n_workers,
+        _pool_config.start_method,
+        _pool_config.chunk_size,
+    )
+
+
+def shutdown_pool() -> None:
+    """
+    stops the shared worker pool, if it is running. It will be
+    started again the next time it is needed.
+    """
+
+    pool = _shared_pool.pool
+    _shared_pool.pool = None
+    _shared_pool.settings = None
+    _shared_pool.main = None
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+@contextlib.contextmanager
+def worker_pool(
+    *,
+    n_workers: Optional[int] = None,
+    start_method: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+):
+    """
+    context manager that runs parfor/splitapply on a pool of
+    processes that only exists inside the with block
+
+    with worker_pool(n_workers=4, start_method="spawn"):
+        result = parfor(func, (X,))
+
+    Args:
+        n_workers (int, optional): number of processes
+        start_method (str, optional): "fork", "forkserver" or "spawn"
+        chunk_size (int, optional): number of items to send to a
+        worker at once
+
+    Yields:
+        multiprocessing.pool.Pool
+    """
+
+    scoped = _start_pool(_make_settings(n_workers, start_method, chunk_size))
+    _scoped_pools.append(scoped)
+    try:
+        yield scoped.pool
+    finally:
+        _scoped_pools.pop()
+        scoped.pool.close()
+        scoped.pool.join()
+
+
+def chunk_edges(n_items: int, *, start: int = 0) -> np.ndarray:
+    """
+    splits range(start, n_items) into chunks, using the chunk size
+    of the current pool, or ~4 chunks per worker if that isn't set
+
+    Args:
+        n_items (int): end of the range
+        start (int, optional): start of the range
+
+    Returns:
+        np.ndarray of edges: chunk i is edges[i]:edges[i+1]
+    """
+
+    settings = pool_settings()
+    if settings.chunk_size is not None:
+        edges = np.arange(start, n_items, settings.chunk_size)
+        return np.append(edges, n_items)
+
+    n_chunks = settings.n_workers * 4
+    return np.unique(np.linspace(start, n_items, n_chunks + 1).astype(int))
+
+
+atexit.register(shutdown_pool)
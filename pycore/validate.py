@@ -2,7 +2,6 @@
 
 import os
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 from beartype import beartype
@@ -55,6 +54,9 @@ def check_axis(axis):
 
     """
 
+    # imported here, so that importing pycore doesn't load matplotlib
+    import matplotlib.pyplot as plt
+
     if axis is None:
         _, axis = plt.subplots()
 
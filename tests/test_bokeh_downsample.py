@@ -0,0 +1,50 @@
+"""
+This module tests functions in pycore.bokeh_downsample
+"""
+import numpy as np
+from bokeh.document import Document
+from bokeh.document.events import (
+    ColumnDataChangedEvent,
+    ColumnsPatchedEvent,
+)
+from bokeh.models import Range1d
+from bokeh.plotting import figure
+
+from pycore import bokeh_downsample
+
+
+def test_attach():
+    """the source should stay small, and follow the x range"""
+
+    rng = np.random.default_rng(0)
+    trace = rng.standard_normal(1_000_000)
+
+    fig = figure(x_range=Range1d(0, 100))
+    source = bokeh_downsample.attach(fig, trace, n_points=500, dx=0.001)
+    assert len(source.data["x"]) == 500, "source should have n_points"
+    assert np.nanmax(source.data["y"]) == trace.max(), "missed the max"
+
+    document = Document()
+    document.add_root(fig)
+
+    # many changes should only schedule one update
+    events = []
+    document.on_change(events.append)
+    fig.x_range.start = 10
+    fig.x_range.end = 10.2
+    callbacks = list(document.session_callbacks)
+    assert len(callbacks) == 1, "range changes were not debounced"
+
+    events.clear()
+    callbacks[0].callback()
+    sent = [type(event) for event in events]
+    assert ColumnsPatchedEvent in sent, "update was not sent as a patch"
+    assert ColumnDataChangedEvent not in sent, "all data was sent"
+    assert len(source.data["x"]) == 500, "columns changed length"
+
+    x = source.data["x"]
+    x = x[~np.isnan(x)]
+    assert np.array_equal(x, np.arange(10_000, 10_201) * 0.001), "wrong x"
+    assert np.array_equal(
+        source.data["y"][: len(x)], trace[10_000:10_201]
+    ), "wrong y"
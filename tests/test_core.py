@@ -4,7 +4,24 @@ This module tests functions in isxcore.core
 import numpy as np
 import pandas as pd
 
-from pycore.core import hash_dict, md5hash, struct
+import hashlib
+import os
+
+import pytest
+
+import pycore.core
+from pycore.core import (
+    clear_hash_cache,
+    hash_backends,
+    hash_cache_stats,
+    hash_dict,
+    hash_file,
+    is_pandas,
+    md5hash,
+    register_hash_backend,
+    resolve_hash_backend,
+    struct,
+)
 
 
 def test_md5hash():
@@ -12,44 +29,173 @@ def test_md5hash():
 
     # int
     assert (
-        md5hash(0) == "7dea362b3fac8e00956a4952a3d4f474"
+        md5hash(0, legacy=True) == "7dea362b3fac8e00956a4952a3d4f474"
     ), "Failure in hashing int"
 
     assert (
-        md5hash(0.0) == "30565a8911a6bb487e3745c0ea3c8224"
+        md5hash(0.0, legacy=True) == "30565a8911a6bb487e3745c0ea3c8224"
     ), "Failure in hashing floats"
 
     assert (
-        md5hash([1.0]) == "3147e474b9c2a5b484473aaebccd5213"
+        md5hash([1.0], legacy=True) == "3147e474b9c2a5b484473aaebccd5213"
     ), "Failure in hashing lists"
 
     assert (
-        md5hash("wow") == "bcedc450f8481e89b1445069acdc3dd9"
+        md5hash("wow", legacy=True) == "bcedc450f8481e89b1445069acdc3dd9"
     ), "Failure in hashing a string"
 
     assert (
-        md5hash(["wow"]) == "96cabca7a92e0ebe17f802ad6e592cb2"
+        md5hash(["wow"], legacy=True) == "96cabca7a92e0ebe17f802ad6e592cb2"
     ), "Failure in hashing a string in a list"
 
     assert (
-        md5hash(["wow", "foo"]) == "74e12dc5917c5035cdb1ae6c692cac34"
+        md5hash(["wow", "foo"], legacy=True)
+        == "74e12dc5917c5035cdb1ae6c692cac34"
     ), "Failure in hashing a list of strings"
 
     df = pd.DataFrame(dict(a=[1, 2, 4], b=["a", "b", "c"]))
 
     assert (
-        md5hash(df) == "3f49ae9563974257fac2e582ae4084df"
+        md5hash(df, legacy=True) == "3f49ae9563974257fac2e582ae4084df"
     ), "Failure in hashing pandas dataframe"
 
     assert (
-        md5hash(np.zeros(10)) == "bbf7c6077962a7c28114dbd10be947cd"
+        md5hash(np.zeros(10), legacy=True)
+        == "bbf7c6077962a7c28114dbd10be947cd"
     ), "Failure in hashing a numpy array"
 
     assert (
-        md5hash((1, 2, "a")) == "8de6e804d698fc88d230c169a509cc20"
+        md5hash((1, 2, "a"), legacy=True) == "8de6e804d698fc88d230c169a509cc20"
     ), "Failure in hashing a tuple"
 
 
+def test_md5hash_streaming():
+    """tests the streaming hashing engine"""
+
+    x = np.random.rand(200, 300)
+
+    assert md5hash(x) == md5hash(x.copy()), "hash is not deterministic"
+
+    assert md5hash(x.T) == md5hash(
+        np.ascontiguousarray(x.T)
+    ), "non-contiguous arrays hash differently from their copies"
+
+    assert md5hash(x[::3, ::2]) == md5hash(
+        x[::3, ::2].copy()
+    ), "strided views hash differently from their copies"
+
+    assert md5hash(np.zeros(10)) != md5hash(
+        np.zeros(80, dtype=np.uint8)
+    ), "arrays with the same bytes but different dtypes collide"
+
+    assert md5hash(["ab"]) != md5hash(
+        ["a", "b"]
+    ), "nested lists with the same contents collide"
+
+    df = pd.DataFrame(dict(a=[1, 2, 4], b=["a", "b", "c"]))
+    assert md5hash(df) == md5hash(df.copy()), "Failure in hashing DataFrame"
+    assert md5hash(df) != md5hash(
+        df.iloc[::-1]
+    ), "reordered DataFrames collide"
+    assert md5hash(df) != md5hash(
+        df.rename(columns=dict(a="x", b="y"))
+    ), "DataFrames with different column names collide"
+    assert md5hash(df) != md5hash(
+        df.astype(dict(a=float))
+    ), "DataFrames with different dtypes collide"
+    assert md5hash(df.a) != md5hash(
+        df.a.rename("x")
+    ), "Series with different names collide"
+
+
+def test_hash_backends():
+    """tests that all backends work, and are prefixed"""
+
+    backends = hash_backends()
+    assert "md5" in backends, "md5 should always be available"
+    assert "blake2b" in backends, "blake2b should always be available"
+
+    x = np.random.rand(100)
+    digests = set()
+    for backend in backends:
+        digest = md5hash(x, backend=backend)
+        assert digest == md5hash(x.copy(), backend=backend)
+        if backend != "md5":
+            assert digest.startswith(backend + ":"), "missing prefix"
+        digests.add(digest)
+
+        assert hash_dict(dict(x=x), backend=backend).startswith(
+            "" if backend == "md5" else backend
+        )
+
+    assert len(digests) == len(backends), "backends collide"
+
+
+def test_hash_backend_env_var(monkeypatch):
+    """the default backend can be picked with an environment variable"""
+
+    monkeypatch.delenv("PYCORE_HASH_BACKEND", raising=False)
+    assert resolve_hash_backend() == "md5"
+    monkeypatch.setenv("PYCORE_HASH_BACKEND", "blake2b")
+    assert md5hash("wow") == md5hash("wow", backend="blake2b")
+    assert resolve_hash_backend() == "blake2b"
+    assert resolve_hash_backend("md5") == "md5"
+
+    # legacy digests are always md5
+    assert md5hash("wow", legacy=True) == "bcedc450f8481e89b1445069acdc3dd9"
+
+    monkeypatch.setenv("PYCORE_HASH_BACKEND", "not-a-backend")
+    with pytest.raises(ValueError):
+        md5hash("wow")
+
+
+def test_register_hash_backend():
+    """tests registering a new backend"""
+
+    register_hash_backend("sha1", hashlib.sha1)
+    assert "sha1" in hash_backends()
+
+    assert md5hash("wow", backend="sha1").startswith("sha1:")
+    assert hash_dict(dict(a=1), backend="sha1").startswith("sha1:")
+
+
+def test_hash_file(tmp_path, monkeypatch):
+    """hashes the bytes of a file, in pieces, or only its ends"""
+
+    content = os.urandom(3000)
+    path = str(tmp_path / "a")
+    with open(path, "wb") as file:
+        file.write(content)
+
+    # read in many pieces
+    monkeypatch.setattr(pycore.core, "_HASH_CHUNK_BYTES", 256)
+    assert hash_file(path) == hashlib.md5(content).hexdigest()
+    assert hash_file(path, backend="blake2b").startswith("blake2b:")
+
+    middle = str(tmp_path / "middle")
+    with open(middle, "wb") as file:
+        file.write(content[:1500] + b"x" + content[1501:])
+    assert hash_file(path, partial_bytes=100) == hash_file(
+        middle, partial_bytes=100
+    ), "only the first and last bytes should be hashed"
+    assert hash_file(path) != hash_file(middle)
+
+    # the ends overlap, so the whole file is hashed once
+    assert hash_file(path, partial_bytes=2000) == hash_file(path)
+
+
+def test_is_pandas():
+    """tests checking for DataFrames and Series"""
+
+    df = pd.DataFrame(dict(a=[1, 2]))
+    assert is_pandas(df)
+    assert is_pandas(df.a)
+    assert is_pandas(df, series=False)
+    assert not is_pandas(df.a, series=False)
+    assert not is_pandas(df.to_numpy())
+    assert not is_pandas(None)
+
+
 def test_struct():
     """tests the struct class"""
     a = struct()
@@ -73,7 +219,7 @@ def test_hash_dict():
 
     correct_hash = "ab57ae69616db0669f32dd8ad9c3d9f8"
 
-    hash = hash_dict(data)
+    hash = hash_dict(data, legacy=True)
 
     assert hash == correct_hash, "unexpected hash"
 
@@ -86,7 +232,7 @@ def test_hash_dict():
     data["baz"] = np.zeros(10)
     data["list"] = ["wow", "so", "list"]
 
-    hash = hash_dict(data)
+    hash = hash_dict(data, legacy=True)
 
     assert hash == correct_hash, "unexpected hash when reordering dictionary"
 
@@ -94,6 +240,52 @@ def test_hash_dict():
     data["ignored1"] = "wow"
     data["ignored2"] = "goo"
 
-    hash = hash_dict(data, ignore_keys=["ignored1", "ignored2"])
+    hash = hash_dict(data, ignore_keys=["ignored1", "ignored2"], legacy=True)
 
     assert hash == correct_hash, "unexpected hash with ignored keys"
+
+    # the streaming hash should also ignore key order,
+    # but not the keys themselves
+    assert hash_dict(data, ignore_keys=["ignored1", "ignored2"]) == hash_dict(
+        dict(reversed(list(data.items()))),
+        ignore_keys=["ignored1", "ignored2"],
+    ), "streaming hash depends on key order"
+
+    assert hash_dict(dict(a=1)) != hash_dict(
+        dict(b=1)
+    ), "streaming hash ignores keys"
+
+
+def test_hash_cache_stats():
+    """tests caching of hashes of immutable values in hash_dict"""
+
+    clear_hash_cache()
+
+    x = np.random.rand(1000)
+    x.flags.writeable = False
+    data = dict(x=x, y=np.zeros(10), name="wow")
+
+    correct_hash = hash_dict(data)
+
+    assert hash_dict(data, cache=True) == correct_hash, "cache changed hash"
+    assert hash_dict(data, cache=True) == correct_hash, "cache changed hash"
+
+    stats = hash_cache_stats()
+    assert stats["misses"] == 1, "read-only array should be hashed once"
+    assert stats["hits"] == 1, "read-only array should be reused"
+    assert stats["uncacheable"] == 4, "mutable values should not be cached"
+    assert stats["entries"] == 1, "expected one cached value"
+
+    # values that are garbage collected are forgotten
+    del data, x
+    assert hash_cache_stats()["entries"] == 0, "cache holds dead values"
+
+    # views of writeable arrays can change, so are not cached
+    y = np.zeros(10)
+    view = y[:]
+    view.flags.writeable = False
+    hash_dict(dict(view=view), cache=True)
+    assert hash_cache_stats()["entries"] == 0, "cached a mutable view"
+
+    clear_hash_cache()
+    assert hash_cache_stats()["misses"] == 0, "stats were not reset"
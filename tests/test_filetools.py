@@ -1,4 +1,49 @@
-from pycore.filetools import format_bytes
+import os
+
+import numpy as np
+import pytest
+
+import pycore.filetools
+from pycore.filetools import (
+    atomic_write,
+    find_duplicates,
+    format_bytes,
+    format_bytes_array,
+    get_folder_size,
+    largest,
+    smallest,
+    top_files,
+)
+
+
+def test_atomic_write(tmp_path):
+    """the file only changes once writing is done, and not at all if
+    writing fails"""
+
+    path = str(tmp_path / "a.txt")
+    with atomic_write(path, "w") as file:
+        file.write("old")
+        assert not os.path.exists(path), "visible before it is written"
+    with open(path) as file:
+        assert file.read() == "old"
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(path, "w") as file:
+            file.write("new")
+            raise RuntimeError("failed while writing")
+    with open(path) as file:
+        assert file.read() == "old", "a failed write changed the file"
+    assert os.listdir(tmp_path) == ["a.txt"], "temporary file left behind"
+
+    with atomic_write(path) as file:
+        np.save(file, np.arange(3))
+    assert np.array_equal(np.load(path), np.arange(3))
+
+    # same permissions as any other new file
+    with open(tmp_path / "b.txt", "w") as file:
+        file.write("b")
+    mode = os.stat(tmp_path / "b.txt").st_mode
+    assert os.stat(path).st_mode == mode, "wrong permissions"
 
 
 def test_format_bytes():
@@ -7,3 +52,245 @@ def test_format_bytes():
     ), "Format bytes failed"
 
     assert format_bytes(900_000_000) == "858.31 MB", "format_bytes failed"
+    assert format_bytes(0) == "0B", "format_bytes failed for 0"
+    assert format_bytes(-1536) == "-1.5 KB", "negative sizes failed"
+    assert format_bytes(1536, units="iec") == "1.5 KiB", "iec failed"
+    assert format_bytes(1500, units="si") == "1.5 kB", "si failed"
+
+    with pytest.raises(AssertionError):
+        format_bytes(1, units="not-units")
+
+
+def test_format_bytes_array():
+    """should match format_bytes on every size"""
+
+    rng = np.random.default_rng(0)
+    sizes = np.concatenate(
+        [
+            rng.integers(-(10**15), 10**18, 10_000),
+            rng.integers(0, 5000, 1000),
+            [0, 1, 1023, 1024, 1025, 999, 1000, 1001, 2**63 - 1],
+            [1029, 1039, 2739],  # close to rounding ties
+        ]
+    )
+
+    for units in ["binary", "iec", "si"]:
+        result = format_bytes_array(sizes, units=units)
+        expected = [format_bytes(int(size), units=units) for size in sizes]
+        assert result.tolist() == expected, f"{units} doesn't match"
+
+    result = format_bytes_array([[0, -1536], [900_000_000, 5]])
+    assert result.shape == (2, 2), "shape was not kept"
+    assert result[1, 0] == "858.31 MB", "format_bytes_array failed"
+
+
+def test_get_folder_size(tmp_path):
+    """sizes should add up over subfolders, skipping links, and the
+    index should notice new files"""
+
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "one").write_bytes(b"x" * 10)
+    (tmp_path / "a" / "two").write_bytes(b"x" * 100)
+    (tmp_path / "a" / "b" / "three").write_bytes(b"x" * 1000)
+    os.symlink(tmp_path / "a" / "two", tmp_path / "link")
+    os.symlink(tmp_path / "a", tmp_path / "linked_folder")
+
+    assert get_folder_size(str(tmp_path)) == 1110, "wrong size"
+    assert get_folder_size(str(tmp_path / "a"), n_workers=1) == 1100
+
+    index_path = str(tmp_path.parent / f"{tmp_path.name}_index.json")
+    assert get_folder_size(str(tmp_path), index_path=index_path) == 1110
+    assert os.path.exists(index_path), "index was not written"
+    assert get_folder_size(str(tmp_path), index_path=index_path) == 1110
+
+    (tmp_path / "a" / "b" / "four").write_bytes(b"x" * 5)
+    assert (
+        get_folder_size(str(tmp_path), index_path=index_path) == 1115
+    ), "index did not notice a new file"
+    os.remove(index_path)
+
+
+def _make_files(folder, sizes):
+    """writes files of some sizes, and returns their paths"""
+    paths = []
+    for i, size in enumerate(sizes):
+        path = folder / f"{i}.bin"
+        path.write_bytes(b"x" * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_top_files(tmp_path):
+    """compares to sorting all files by size"""
+
+    sizes = [5, 50, 0, 7, 50, 3, 100, 1]
+    paths = _make_files(tmp_path, sizes)
+
+    result = top_files(paths, 3)
+    assert result == [
+        (paths[6], 100),
+        (paths[1], 50),
+        (paths[4], 50),
+    ], "wrong largest files"
+
+    result = top_files(iter(paths), 2, smallest=True)
+    assert result == [(paths[2], 0), (paths[7], 1)], "wrong smallest files"
+
+    assert len(top_files(paths, 100)) == len(paths), "k > number of files"
+    assert top_files([], 3) == [], "no files should give no results"
+
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "big.dat").write_bytes(b"x" * 1000)
+    os.symlink(tmp_path / "sub" / "big.dat", tmp_path / "link.dat")
+
+    assert top_files(str(tmp_path), 1) == [
+        (str(tmp_path / "sub" / "big.dat"), 1000)
+    ], "folder search failed"
+    assert top_files(str(tmp_path / "*.bin"), 1) == [(paths[6], 100)]
+
+    # broken links and files that are gone are skipped
+    os.symlink(tmp_path / "missing.bin", tmp_path / "broken.bin")
+    assert top_files(str(tmp_path / "*.bin"), 1) == [(paths[6], 100)]
+    result = top_files([str(tmp_path / "missing.bin"), paths[0]], 2)
+    assert result == [(paths[0], 5)], "missing files should be skipped"
+
+
+def test_top_files_unreadable_folder(tmp_path, monkeypatch):
+    """folders that can't be read are skipped"""
+
+    (tmp_path / "locked").mkdir()
+    (tmp_path / "locked" / "big.dat").write_bytes(b"x" * 1000)
+    (tmp_path / "open").mkdir()
+    (tmp_path / "open" / "small.dat").write_bytes(b"x" * 10)
+
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if os.path.basename(path) == "locked":
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", locked_scandir)
+    assert top_files(str(tmp_path), 2) == [
+        (str(tmp_path / "open" / "small.dat"), 10)
+    ]
+
+
+def test_largest(tmp_path):
+    paths = _make_files(tmp_path, [5, 50, 7, 50])
+    assert largest(paths) == paths[1], "largest failed"
+
+    with pytest.raises(ValueError):
+        largest([])
+
+
+def test_smallest(tmp_path):
+    paths = _make_files(tmp_path, [5, 50, 5, 50])
+    assert smallest(paths) == paths[0], "smallest failed"
+
+    with pytest.raises(ValueError):
+        smallest([])
+
+
+def test_find_duplicates(tmp_path):
+    """files that only differ in the middle should not be duplicates,
+    and the index should give the same answer"""
+
+    content = os.urandom(3000)
+    (tmp_path / "a").write_bytes(content)
+    (tmp_path / "b").write_bytes(content)
+    (tmp_path / "middle").write_bytes(content[:1500] + b"x" + content[1501:])
+    (tmp_path / "c").write_bytes(b"hello")
+    (tmp_path / "d").write_bytes(b"hello")
+    (tmp_path / "e").write_bytes(b"world")
+    (tmp_path / "empty1").write_bytes(b"")
+    (tmp_path / "empty2").write_bytes(b"")
+
+    paths = sorted(str(path) for path in tmp_path.iterdir())
+    expected = [
+        [str(tmp_path / "a"), str(tmp_path / "b")],
+        [str(tmp_path / "c"), str(tmp_path / "d")],
+    ]
+    assert find_duplicates(paths, partial_bytes=100) == expected
+
+    index_path = str(tmp_path.parent / f"{tmp_path.name}_index.json")
+    for backend in ["md5", "blake2b", "blake2b"]:
+        result = find_duplicates(
+            paths, partial_bytes=100, backend=backend, index_path=index_path
+        )
+        assert result == expected, f"failed with {backend} and an index"
+
+    # found by searching a folder too
+    result = find_duplicates(str(tmp_path), partial_bytes=100)
+    assert sorted(map(sorted, result)) == expected, "folder search failed"
+    os.remove(index_path)
+
+
+def test_find_duplicates_reused_index(tmp_path, monkeypatch):
+    """an index from runs with another partial_bytes, and folders that
+    can't be read, don't change which files are duplicates"""
+
+    folder = tmp_path / "files"
+    folder.mkdir()
+    content = os.urandom(3000)
+    (folder / "a").write_bytes(content)
+    (folder / "b").write_bytes(content)
+    index_path = str(tmp_path / "index.json")
+
+    # a and b are hashed completely here, but c isn't below
+    result = find_duplicates(
+        str(folder), partial_bytes=1000, index_path=index_path
+    )
+    assert sorted(map(sorted, result)) == [
+        [str(folder / "a"), str(folder / "b")]
+    ]
+
+    (folder / "c").write_bytes(content)
+    (folder / "locked").mkdir()
+    (folder / "locked" / "d").write_bytes(content)
+
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if os.path.basename(path) == "locked":
+            raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", locked_scandir)
+    result = find_duplicates(
+        str(folder), partial_bytes=2000, index_path=index_path
+    )
+    assert sorted(map(sorted, result)) == [
+        [str(folder / name) for name in ["a", "b", "c"]]
+    ], "stale full hashes split duplicates"
+
+
+def test_find_duplicates_links(tmp_path, monkeypatch):
+    """hard links aren't duplicates, and files that can't be read are
+    skipped"""
+
+    content = os.urandom(3000)
+    (tmp_path / "a").write_bytes(content)
+    (tmp_path / "b").write_bytes(content)
+    (tmp_path / "c").write_bytes(content)
+    os.link(tmp_path / "a", tmp_path / "a_link")
+    os.symlink(tmp_path / "missing", tmp_path / "broken")
+
+    paths = [str(tmp_path / name) for name in ["a", "a_link", "broken", "b"]]
+    expected = [[str(tmp_path / "a"), str(tmp_path / "b")]]
+    assert find_duplicates(paths, partial_bytes=100) == expected
+    assert find_duplicates(paths[:2]) == [], "hard links aren't copies"
+
+    # c is deleted after it is stat-ed, but before it is read
+    hash_file = pycore.filetools.hash_file
+
+    def deleted(path, **kwargs):
+        if path == str(tmp_path / "c"):
+            raise FileNotFoundError(path)
+        return hash_file(path, **kwargs)
+
+    monkeypatch.setattr(pycore.filetools, "hash_file", deleted)
+    paths.append(str(tmp_path / "c"))
+    for partial_bytes in [100, 1 << 20]:
+        result = find_duplicates(paths, partial_bytes=partial_bytes)
+        assert result == expected, "unreadable files should be skipped"
@@ -0,0 +1,112 @@
+"""
+This module tests functions in pycore.graphics
+"""
+import numpy as np
+import pandas as pd
+
+from pycore.graphics import (
+    MinMaxPyramid,
+    minmax_decimate,
+    scatter_groups,
+    subsample,
+)
+
+
+def test_minmax_decimate(tmp_path):
+    """tests decimating vectors, many channels, memmaps and chunks"""
+
+    rng = np.random.default_rng(0)
+    trace = rng.random(1030)
+
+    x, y = minmax_decimate(trace, bin_size=50)
+    assert x.shape == y.shape == (42,), "last partial bin was dropped"
+    assert np.array_equal(trace[x], y), "x doesn't point at y"
+    assert np.all(np.diff(x) >= 0), "min and max are out of order"
+    assert np.allclose(
+        np.sort(y[:40].reshape(20, 2), axis=1),
+        subsample(trace, bin_size=50).reshape(20, 2),
+    ), "doesn't match subsample"
+    assert y[-2:].min() == trace[1000:].min(), "wrong last bin"
+
+    data = rng.random((1030, 4))
+    x, y = minmax_decimate(data, bin_size=50)
+    assert x.shape == (42, 4), "wrong shape for channels"
+    for channel in range(4):
+        expected = minmax_decimate(data[:, channel], bin_size=50)
+        assert np.array_equal(x[:, channel], expected[0])
+        assert np.array_equal(y[:, channel], expected[1])
+
+    transposed = minmax_decimate(data.T, bin_size=50, axis=1)
+    assert np.array_equal(transposed[0], x.T), "axis was ignored"
+
+    # chunks that don't line up with bins
+    chunks = (data[i : i + 37] for i in range(0, len(data), 37))
+    streamed = minmax_decimate(chunks, bin_size=50)
+    assert np.array_equal(streamed[0], x), "streaming gave different x"
+    assert np.array_equal(streamed[1], y), "streaming gave different y"
+
+    path = str(tmp_path / "data.npy")
+    np.save(path, data)
+    on_disk = minmax_decimate(np.load(path, mmap_mode="r"), bin_size=50)
+    assert np.array_equal(on_disk[1], y), "memmap gave different y"
+
+
+def test_minmax_pyramid(tmp_path):
+    """every level should match decimating the whole trace, and
+    queries should return few points from the right place"""
+
+    rng = np.random.default_rng(0)
+    trace = rng.standard_normal(100_123)
+    pyramid = MinMaxPyramid(trace, bin_size=16, factor=4)
+
+    assert len(pyramid.levels[-1][0]) == 2, "top level should be one bin"
+    for (x, y), bin_size in zip(pyramid.levels, pyramid.bin_sizes):
+        assert np.array_equal(trace[x], y), "x doesn't point at y"
+        _, expected = minmax_decimate(trace, bin_size)
+        assert np.array_equal(
+            np.sort(y.reshape(-1, 2), axis=1),
+            np.sort(expected.reshape(-1, 2), axis=1),
+        ), f"level with bins of {bin_size} is wrong"
+
+    x, y = pyramid.query(1000, 90_000, n_points=500)
+    assert 0 < len(x) <= 500, "too many points"
+    assert x[0] < 1100 and x[-1] > 89_000, "points don't cover the range"
+    assert y.max() == trace[x[0] : x[-1] + 1].max(), "missed the max"
+
+    x, y = pyramid.query(10, 20, n_points=500)
+    assert np.array_equal(x, np.arange(10, 20)), "short ranges are raw"
+    assert np.array_equal(y, trace[10:20])
+
+    # stored pyramids are reused
+    stored = MinMaxPyramid(trace, bin_size=16, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2, "pyramid not stored"
+    loaded = MinMaxPyramid(trace, bin_size=16, cache_dir=str(tmp_path))
+    assert isinstance(loaded.levels[0][1], np.memmap), "not loaded"
+    for a, b in zip(stored.query(0, 100_000), loaded.query(0, 100_000)):
+        assert np.array_equal(a, b), "loaded pyramid is different"
+
+
+def test_scatter_groups():
+    """every group should be one renderer, all sharing one source"""
+
+    data = pd.DataFrame(
+        dict(
+            a=np.arange(6.0),
+            b=np.arange(6.0) * 2,
+            group=["x", "y", "x", np.nan, "y", "x"],
+        )
+    )
+    fig = scatter_groups(data, "a", "b", "group")
+
+    labels = [item.label.value for item in fig.legend.items]
+    assert labels == ["x", "y", "nan"], "wrong groups"
+    assert len({r.data_source.id for r in fig.renderers}) == 1
+    rows = [list(r.view.filter.indices) for r in fig.renderers]
+    assert rows == [[0, 2, 5], [1, 4], [3]], "wrong rows in groups"
+
+    # more groups than the colorblind palette has colors
+    data = pd.DataFrame(dict(a=np.arange(20.0), b=np.arange(20.0)))
+    data["group"] = data.a.astype(int).astype(str)
+    fig = scatter_groups(data, "a", "b", "group")
+    colors = [r.glyph.fill_color for r in fig.renderers]
+    assert len(set(colors)) == 20, "groups should have different colors"
@@ -0,0 +1,64 @@
+"""
+This module tests that importing pycore stays fast, by checking that
+heavy dependencies are only imported when they are used
+"""
+import subprocess
+import sys
+
+import pytest
+
+# modules that scripts import, and that should load quickly
+LIGHT_MODULES = [
+    "pycore",
+    "pycore.core",
+    "pycore.matlab",
+    "pycore.maths",
+    "pycore.parallel",
+    "pycore.memoize",
+    "pycore.filetools",
+]
+
+HEAVY_DEPENDENCIES = ["matplotlib", "bokeh", "scipy", "pandas"]
+
+
+def _imported_modules(module: str) -> set:
+    """names of all modules imported by "import module", according to
+    python -X importtime"""
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        name = line.rsplit("|", 1)[1].strip()
+        modules.add(name)
+    return modules
+
+
+@pytest.mark.parametrize("module", LIGHT_MODULES)
+def test_lazy_imports(module):
+    """importing pycore's core modules should not load plotting
+    libraries, scipy or pandas"""
+
+    modules = _imported_modules(module)
+    assert module in modules, "importtime output was not understood"
+
+    for dependency in HEAVY_DEPENDENCIES:
+        assert dependency not in modules, f"{module} imported {dependency}"
+
+
+def test_lazy_submodules():
+    """submodules should be available as attributes of pycore"""
+
+    import pycore
+
+    assert pycore.maths.cluster_corr is not None
+    assert "graphics" in dir(pycore)
+    with pytest.raises(AttributeError):
+        pycore.not_a_module
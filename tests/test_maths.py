@@ -0,0 +1,191 @@
+"""
+This module tests functions in pycore.maths
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.cluster.hierarchy as sch
+import scipy.signal
+from scipy import stats
+
+from pycore.maths import (
+    cluster_corr,
+    cross_correlation,
+    cross_correlation_matrix,
+    fit_cluster_corr,
+)
+
+
+def _block_corr(n: int = 300, n_groups: int = 5) -> np.ndarray:
+    """correlation matrix of variables that come in groups"""
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, n_groups, n)
+    signals = rng.standard_normal((1000, n_groups))[:, groups]
+    return np.corrcoef((signals + 0.5 * rng.standard_normal((1000, n))).T)
+
+
+def test_cluster_corr():
+    """tests all methods of clustering correlation matrices"""
+
+    corr = _block_corr()
+
+    # what cluster_corr used to do
+    distances = sch.distance.pdist(corr)
+    linkage = sch.linkage(distances, method="complete")
+    labels = sch.fcluster(linkage, distances.max() / 2, criterion="distance")
+    idx = np.argsort(labels)
+    expected = corr[idx, :][:, idx]
+
+    assert np.array_equal(cluster_corr(corr), expected), "exact failed"
+
+    df = pd.DataFrame(corr)
+    assert cluster_corr(df).equals(df.iloc[idx, idx]), "DataFrame failed"
+
+    copy = corr.copy()
+    assert cluster_corr(copy, inplace=True) is copy, "not in place"
+    assert np.array_equal(copy, expected), "in place reordering failed"
+
+    for method in ["blockwise", "sample", "auto"]:
+        result = cluster_corr(corr, method=method, sample_size=100)
+        assert result.shape == corr.shape, f"{method} failed"
+
+        # every group of variables should be contiguous, so the
+        # reordered matrix has as few jumps as the exact one
+        jumps = np.sum(np.abs(np.diff(result[0])) > 0.5)
+        assert jumps <= np.sum(np.abs(np.diff(expected[0])) > 0.5) + 2
+
+
+def test_fit_cluster_corr():
+    """tests reusing and extending clusterings"""
+
+    corr = _block_corr()
+
+    clustering = fit_cluster_corr(corr)
+    assert len(clustering) == len(corr), "wrong number of variables"
+    assert np.array_equal(
+        clustering.apply(corr), cluster_corr(corr)
+    ), "apply should match cluster_corr"
+    assert fit_cluster_corr(corr) is clustering, "clustering not cached"
+    assert fit_cluster_corr(corr, cache=False) is not clustering
+
+    # other matrices of the same variables are reordered the same way
+    other = np.arange(corr.size, dtype=float).reshape(corr.shape)
+    idx = clustering.permutation
+    assert np.array_equal(clustering.apply(other), other[idx][:, idx])
+
+    with pytest.raises(AssertionError):
+        clustering.apply(corr[:10, :10])
+
+    # adding variables keeps the old order, and puts new variables
+    # into the right groups
+    bigger = _block_corr(n=330)
+    old = fit_cluster_corr(bigger[:300, :300])
+    extended = old.add_variables(bigger)
+    assert len(extended) == 330, "variables were not added"
+    assert np.array_equal(
+        extended.permutation[extended.permutation < 300], old.permutation
+    ), "old variables were reordered"
+
+    result = extended.apply(bigger)
+    jumps = np.sum(np.abs(np.diff(result[0])) > 0.5)
+    expected = old.apply(bigger[:300, :300])
+    assert jumps <= np.sum(np.abs(np.diff(expected[0])) > 0.5) + 2
+
+    # DataFrames find old variables by name
+    names = [f"v{i}" for i in range(330)]
+    df = pd.DataFrame(bigger, index=names, columns=names)
+    old = fit_cluster_corr(df.iloc[:300, :300])
+    shuffled = df.iloc[::-1, ::-1]
+    result = old.add_variables(shuffled).apply(shuffled)
+    old_names = old.apply(df.iloc[:300, :300]).index
+    assert list(result.index[result.index.isin(old_names)]) == list(
+        old_names
+    ), "old variables were not found by name"
+
+
+def test_cross_correlation():
+    """compares to correlating every chunk with scipy"""
+
+    rng = np.random.default_rng(0)
+    x = rng.random(10_500)
+    y = np.roll(x, 3) + rng.random(10_500) * 0.1
+
+    c = cross_correlation(x, y, chunk_size=1000)
+    assert c.shape == (1000, 11), "wrong shape"
+    assert np.all(np.isnan(c[:, -1])), "partial chunk should be NaN"
+
+    for i in range(10):
+        a = stats.zscore(x[i * 1000 : (i + 1) * 1000])
+        b = stats.zscore(y[i * 1000 : (i + 1) * 1000])
+        expected = scipy.signal.correlate(a, b, mode="same") / 1000
+        assert np.allclose(c[:, i], expected), f"chunk {i} is wrong"
+
+    # signals shorter than a chunk are one chunk
+    c = cross_correlation(x[:500], y[:500], chunk_size=1000)
+    assert c.shape == (500, 1), "wrong shape for short signals"
+
+    with pytest.raises(RuntimeError):
+        cross_correlation(np.full(10, np.nan), x[:10])
+
+
+def test_cross_correlation_out_of_core(tmp_path):
+    """signals on disk should give the same answer as in memory"""
+
+    rng = np.random.default_rng(0)
+    x = rng.random(10_500).astype(np.float32)
+    y = rng.random(10_500).astype(np.float32)
+
+    x.tofile(tmp_path / "x.bin")
+    y.tofile(tmp_path / "y.bin")
+
+    expected = cross_correlation(x, y, chunk_size=1000)
+
+    c = cross_correlation(
+        str(tmp_path / "x.bin"),
+        tmp_path / "y.bin",
+        dtype=np.float32,
+        chunk_size=1000,
+        out=str(tmp_path / "c.npy"),
+    )
+    assert isinstance(c, np.memmap), "output should be memory-mapped"
+    assert np.allclose(c, expected, equal_nan=True), "wrong result"
+    assert np.allclose(
+        np.load(tmp_path / "c.npy"), expected, equal_nan=True
+    ), "result not written to disk"
+
+    out = np.zeros((1000, 11))
+    c = cross_correlation(
+        np.memmap(tmp_path / "x.bin", dtype=np.float32, mode="r"),
+        y,
+        chunk_size=1000,
+        out=out,
+    )
+    assert c is out, "result not written to out"
+    assert np.allclose(out, expected, equal_nan=True), "wrong result"
+
+
+def test_cross_correlation_matrix():
+    """compares every pair to cross_correlation"""
+
+    rng = np.random.default_rng(0)
+    X = rng.random((1000, 5))
+    X[:, 2] = np.roll(X[:, 0], 7)
+
+    c = cross_correlation_matrix(X)
+    rows, cols = np.triu_indices(5)
+    assert c.shape == (1000, len(rows)), "wrong shape"
+
+    for k, (i, j) in enumerate(zip(rows, cols)):
+        expected = cross_correlation(X[:, i], X[:, j], chunk_size=1000)
+        assert np.allclose(c[:, k], expected[:, 0]), f"pair {i, j} is wrong"
+
+    c = cross_correlation_matrix(X, max_lag=10)
+    assert c.shape == (21, len(rows)), "wrong shape with max_lag"
+
+    peak_lag, peak_value = cross_correlation_matrix(
+        X, max_lag=10, reduce="peak"
+    )
+    assert peak_lag[2, 0] == 7, "wrong peak lag"
+    assert peak_lag[0, 2] == -7, "peak lags should be antisymmetric"
+    assert np.allclose(peak_value, peak_value.T), "peaks not symmetric"
+    assert np.allclose(np.diag(peak_value), 1), "autocorrelation peak != 1"
@@ -0,0 +1,381 @@
+"""
+This module tests functions in pycore.matlab
+"""
+import functools
+import time
+
+import numpy as np
+import pytest
+
+import pycore.matlab
+from pycore.matlab import (
+    find_runs,
+    first_nonzero,
+    last_nonzero,
+    nonzero_bounds,
+    parfor,
+    run_length_decode,
+    run_length_encode,
+    splitapply,
+)
+from pycore.parallel import worker_pool
+
+
+def test_splitapply():
+    """tests that fast reducers match calling func on every group"""
+
+    rng = np.random.default_rng(0)
+
+    for shape in [(1000,), (1000, 3)]:
+        data = rng.random(shape)
+        data[rng.random(shape) < 0.1] = np.nan
+        groups = rng.integers(0, 50, 1000)
+
+        for func in [
+            np.nanmean,
+            np.nansum,
+            np.nanmax,
+            np.nanmin,
+            np.nanstd,
+            np.median,
+            np.nanmedian,
+        ]:
+            expected = np.array(
+                [func(data[groups == value]) for value in np.unique(groups)]
+            )
+            result = splitapply(data, groups=groups, func=func)
+            assert np.allclose(
+                result, expected, equal_nan=True
+            ), f"splitapply failed for {func.__name__}"
+
+            # the same thing, but via the slow path
+            result = splitapply(data, groups=groups, func=lambda x: func(x))
+            assert np.allclose(
+                result, expected, equal_nan=True
+            ), f"splitapply failed for generic {func.__name__}"
+
+        count = splitapply(data, groups=groups, func="count")
+        expected = [
+            np.sum(~np.isnan(data[groups == value]))
+            for value in np.unique(groups)
+        ]
+        assert np.array_equal(count, expected), "count failed"
+
+    # funcs that return vectors
+    data = rng.random((100, 3))
+    groups = np.repeat([3, 1, 2, 0], 25)
+    result = splitapply(
+        data, groups=groups, func=lambda x: np.nanmean(x, axis=0)
+    )
+    assert result.shape == (4, 3), "wrong shape for vector outputs"
+    assert np.allclose(result[3], data[:25].mean(axis=0))
+
+    # groups that aren't numbers
+    groups = np.array(["b", "a", "b", "c"])
+    result = splitapply(np.arange(4.0), groups=groups, func=np.nansum)
+    assert np.array_equal(result, [1.0, 2.0, 3.0]), "string groups failed"
+
+    with pytest.raises(ValueError):
+        splitapply(np.arange(4.0), groups=groups, func="not-a-reducer")
+
+    # uint64 groups that don't fit in an int64
+    groups = np.array([2**63 + 5, 2**63 + 1, 2**63 + 5], dtype=np.uint64)
+    result = splitapply(np.arange(3.0), groups=groups, func=np.nansum)
+    assert np.array_equal(result, [1.0, 2.0]), "uint64 groups failed"
+
+
+def _first_row(x):
+    """returns a view of its input, to make sure parallel
+    splitapply copies outputs out of shared memory"""
+    return x[0]
+
+
+def test_splitapply_parallel():
+    """tests that running on a process pool gives the same answer"""
+
+    rng = np.random.default_rng(0)
+    data = rng.random((10_000, 2))
+    groups = rng.integers(0, 100, 10_000)
+
+    for func in [np.ptp, _first_row]:
+        serial = splitapply(data, groups=groups, func=func)
+        parallel = splitapply(data, groups=groups, func=func, n_jobs=2)
+        assert np.array_equal(serial, parallel), "parallel splitapply failed"
+
+
+def _norm_and_sum(x, y):
+    """returns a small vector for every column"""
+    return np.array([np.linalg.norm(x - y), np.sum(x)])
+
+
+def test_parfor():
+    """tests parfor, with and without shared memory"""
+
+    rng = np.random.default_rng(0)
+    x = rng.random((50, 40))
+    y = rng.random((50, 40))
+
+    for shared_memory in [True, False]:
+        result = parfor(np.add, (x, y), shared_memory=shared_memory)
+        assert np.allclose(result, x + y), "parfor failed on columns"
+
+        result = parfor(np.dot, (x, y), False, shared_memory=shared_memory)
+        assert np.allclose(result, (x * y).sum(axis=1)), "parfor failed"
+
+        result = parfor(_norm_and_sum, (x, y), shared_memory=shared_memory)
+        assert result.shape == (2, 40), "wrong shape for vector outputs"
+        assert np.allclose(result[1], x.sum(axis=0)), "parfor failed"
+
+    for backend in ["process", "thread", "serial", "auto"]:
+        result = parfor(_norm_and_sum, (x, y), backend=backend)
+        assert result.shape == (2, 40), f"wrong shape with {backend}"
+        assert np.allclose(result[1], x.sum(axis=0)), f"{backend} failed"
+
+        result = parfor(np.dot, (x, y), False, backend=backend)
+        assert np.allclose(result, (x * y).sum(axis=1)), f"{backend} failed"
+
+    with pytest.raises(AssertionError):
+        parfor(np.add, (x, y), backend="not-a-backend")
+
+
+def _mean_or_zero(x):
+    """an int for empty columns, and a float for the rest"""
+    return 0 if x.max() == 0 else x.mean()
+
+
+def _repeat_x(x):
+    """strings of different lengths"""
+    return "x" * int(x[0])
+
+
+def test_parfor_mixed_outputs():
+    """outputs that don't fit in an array made from the first one
+    should not be cast or cut short"""
+
+    x = np.arange(15.0).reshape(3, 5)
+    x[:, 0] = 0
+    expected = np.array([0, 6, 7, 8, 9], dtype=float)
+    strings = np.array(["", "x", "xx", "xxx", "xxxx"])
+
+    for shared_memory in [True, False]:
+        result = parfor(_mean_or_zero, (x,), shared_memory=shared_memory)
+        assert result.dtype == float, "float outputs were cast to int"
+        assert np.array_equal(result, expected), "wrong outputs"
+
+        result = parfor(_repeat_x, (x,), shared_memory=shared_memory)
+        assert np.array_equal(result, strings), "strings were cut short"
+
+    for backend in ["thread", "serial", "auto"]:
+        result = parfor(_mean_or_zero, (x,), backend=backend)
+        assert result.dtype == float, f"outputs were cast with {backend}"
+        assert np.array_equal(result, expected), f"{backend} failed"
+
+        result = parfor(_repeat_x, (x,), backend=backend)
+        assert np.array_equal(result, strings), f"{backend} cut strings"
+
+
+def _log_call(path, x):
+    """notes which column it was called on, and returns nothing"""
+    time.sleep(0.01)
+    with open(path, "a") as file:
+        file.write(f"{int(x[0])}\n")
+
+
+def test_parfor_calls_once(tmp_path):
+    """func runs once per column, including the columns parfor runs
+    to pick a backend or the shape of the output"""
+
+    x = np.tile(np.arange(10.0), (2, 1))
+    path = tmp_path / "calls.txt"
+    func = functools.partial(_log_call, str(path))
+
+    # with a single worker, "auto" never tries threads
+    with worker_pool(n_workers=2):
+        for backend in ["process", "thread", "serial", "auto"]:
+            for shared_memory in [True, False]:
+                path.write_text("")
+                result = parfor(
+                    func, (x,), shared_memory=shared_memory, backend=backend
+                )
+                assert result.shape == (10,)
+                calls = sorted(map(int, path.read_text().split()))
+                assert calls == list(range(10)), f"{backend} repeated calls"
+
+
+def test_first_nonzero(tmp_path):
+    """compares to finding nonzero elements with argmax, for several
+    shapes and axes, in memory and on disk"""
+
+    rng = np.random.default_rng(0)
+
+    for shape in [(1000,), (300, 40), (7, 50, 30)]:
+        for density in [0, 0.001, 0.5]:
+            arr = (rng.random(shape) < density) * rng.random(shape)
+            for axis in range(len(shape)):
+                mask = arr != 0
+                expected = np.where(
+                    mask.any(axis=axis), mask.argmax(axis=axis), -1
+                )
+                result = first_nonzero(arr, axis=axis)
+                assert result.shape == expected.shape, "wrong shape"
+                assert np.array_equal(result, expected), "wrong index"
+
+    arr = np.zeros(3_000_000, dtype=np.float32)
+    arr[2_500_000] = 1
+    path = str(tmp_path / "trace.npy")
+    np.save(path, arr)
+    assert first_nonzero(np.load(path, mmap_mode="r")) == 2_500_000
+    assert first_nonzero(np.zeros(10), invalid_val=np.nan).dtype == float
+
+
+def test_last_nonzero(tmp_path):
+    """compares to finding nonzero elements in a flipped array"""
+
+    rng = np.random.default_rng(0)
+
+    for shape in [(1000,), (300, 40), (7, 50, 30)]:
+        for density in [0, 0.001, 0.5]:
+            arr = (rng.random(shape) < density) * rng.random(shape)
+            for axis in range(len(shape)):
+                mask = np.flip(arr != 0, axis=axis)
+                expected = np.where(
+                    mask.any(axis=axis),
+                    arr.shape[axis] - mask.argmax(axis=axis) - 1,
+                    -1,
+                )
+                result = last_nonzero(arr, axis=axis)
+                assert result.shape == expected.shape, "wrong shape"
+                assert np.array_equal(result, expected), "wrong index"
+
+    arr = np.zeros(3_000_000, dtype=np.float32)
+    arr[500_000] = 1
+    path = str(tmp_path / "trace.npy")
+    np.save(path, arr)
+    assert last_nonzero(np.load(path, mmap_mode="r")) == 500_000
+
+
+def test_nonzero_bounds():
+    """should match first_nonzero and last_nonzero"""
+
+    rng = np.random.default_rng(0)
+
+    for shape in [(1000,), (3_000_000,), (300, 40)]:
+        for density in [0, 1e-6, 0.01]:
+            arr = rng.random(shape) < density
+            for axis in range(len(shape)):
+                first, last = nonzero_bounds(arr, axis=axis)
+                assert np.array_equal(first, first_nonzero(arr, axis=axis))
+                assert np.array_equal(last, last_nonzero(arr, axis=axis))
+
+
+def test_nonzero_bounds_many_lanes(monkeypatch):
+    """lanes are scanned in groups when there are too many of them to
+    read a block of every lane at once"""
+
+    rng = np.random.default_rng(0)
+
+    # a small budget, so that small arrays have "too many" lanes
+    monkeypatch.setattr(pycore.matlab, "_NONZERO_BLOCK_BYTES", 1 << 12)
+    monkeypatch.setattr(pycore.matlab, "_NONZERO_MIN_BLOCK", 16)
+
+    for shape in [(5000, 30), (30, 5000), (40, 70, 50)]:
+        arr = rng.random(shape) < 0.01
+        for axis in range(len(shape)):
+            mask = np.flip(arr, axis=axis)
+            found = arr.any(axis=axis)
+            first, last = nonzero_bounds(arr, axis=axis)
+            assert np.array_equal(
+                first, np.where(found, arr.argmax(axis=axis), -1)
+            )
+            assert np.array_equal(
+                last,
+                np.where(found, shape[axis] - mask.argmax(axis=axis) - 1, -1),
+            )
+    monkeypatch.undo()
+
+    # with a block of one element per lane, numpy was called once per
+    # element along axis. Blocks should be long, and fit the budget
+    scans = []
+    scan_nonzero = pycore.matlab._scan_nonzero
+
+    def record_scan(lanes, block, *args):
+        scans.append((lanes.shape, block))
+        return scan_nonzero(lanes, block, *args)
+
+    monkeypatch.setattr(pycore.matlab, "_scan_nonzero", record_scan)
+
+    arr = np.zeros((2_000_000, 8), dtype=bool)
+    arr[:, 4] = True
+    first, last = nonzero_bounds(arr, axis=1)
+    assert np.all(first == 4) and np.all(last == 4)
+    assert sum(shape[0] for shape, _ in scans) == 2_000_000, "lanes missed"
+    for shape, block in scans:
+        assert block == 8, "blocks should cover short axes at once"
+        assert shape[0] * block <= pycore.matlab._NONZERO_BLOCK_BYTES
+
+    scans.clear()
+    first, last = nonzero_bounds(arr, axis=0)
+    assert np.array_equal(first, [-1, -1, -1, -1, 0, -1, -1, -1])
+    assert scans[0][1] >= pycore.matlab._NONZERO_MIN_BLOCK, "short blocks"
+
+
+def test_run_length_encode():
+    """runs should be maximal, and decode back to the input, no
+    matter how the input is chunked"""
+
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 3, 1000).astype(float)
+    arr[rng.random(1000) < 0.1] = np.nan
+
+    values, lengths = run_length_encode(arr)
+    assert lengths.sum() == len(arr), "lengths don't add up"
+    assert np.all(lengths > 0), "empty runs"
+    same = (values[1:] == values[:-1]) | (
+        np.isnan(values[1:]) & np.isnan(values[:-1])
+    )
+    assert not np.any(same), "neighbouring runs should differ"
+
+    for chunk_size in [1, 7, 100]:
+        chunked = run_length_encode(arr, chunk_size=chunk_size)
+        assert np.array_equal(chunked[0], values, equal_nan=True)
+        assert np.array_equal(chunked[1], lengths), "chunks not stitched"
+
+    values, lengths = run_length_encode(np.array([1, 1, 2, 1]))
+    assert np.array_equal(values, [1, 2, 1]), "wrong values"
+    assert np.array_equal(lengths, [2, 1, 1]), "wrong lengths"
+
+    values, lengths = run_length_encode(np.zeros(0))
+    assert len(values) == len(lengths) == 0, "empty input failed"
+
+
+def test_run_length_decode():
+    """tested in test_run_length_encode"""
+
+    arr = np.array([5, 5, 5, 0, 2, 2])
+    assert np.array_equal(run_length_decode(*run_length_encode(arr)), arr)
+
+
+def test_find_runs(tmp_path):
+    """runs should cover exactly the nonzero elements, also when
+    reading from disk in chunks"""
+
+    trace = np.array([0, 1, 1, 0, 0, 3, 0, 1])
+    runs = find_runs(trace)
+    assert np.array_equal(runs["start"], [1, 5, 7]), "wrong starts"
+    assert np.array_equal(runs["stop"], [3, 6, 8]), "wrong stops"
+    assert np.array_equal(runs["length"], [2, 1, 1]), "wrong lengths"
+
+    rng = np.random.default_rng(0)
+    trace = rng.random(10_000) < 0.4
+    path = str(tmp_path / "trace.npy")
+    np.save(path, trace)
+
+    for chunk_size in [1, 3, 1000, 100_000]:
+        runs = find_runs(np.load(path, mmap_mode="r"), chunk_size=chunk_size)
+        covered = np.zeros(len(trace), dtype=bool)
+        for start, stop, _ in runs:
+            covered[start:stop] = True
+        assert np.array_equal(covered, trace), f"failed for {chunk_size}"
+        assert np.all(runs["start"][1:] > runs["stop"][:-1]), "runs touch"
+
+    assert len(find_runs(np.zeros(10))) == 0, "found runs of zeros"
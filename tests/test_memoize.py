@@ -0,0 +1,101 @@
+"""
+This module tests functions in pycore.memoize
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pycore.memoize import clear_cache, memoize
+
+
+def test_memoize(tmp_path):
+    """tests that results are stored, reused and invalidated"""
+
+    calls = []
+
+    @memoize(cache_dir=str(tmp_path))
+    def expensive(x, *, scale=1.0):
+        calls.append(1)
+        return x * scale
+
+    x = np.random.rand(100)
+
+    first = expensive(x, scale=2.0)
+    second = expensive(x, scale=2.0)
+    assert len(calls) == 1, "result was not reused"
+    assert np.array_equal(first, second), "stored result is different"
+    assert len(os.listdir(tmp_path)) == 1, "expected one result on disk"
+
+    expensive(x, scale=3.0)
+    expensive(x + 1, scale=2.0)
+    assert len(calls) == 3, "different arguments should not hit the cache"
+
+    @memoize(cache_dir=str(tmp_path))
+    def frame(n):
+        calls.append(1)
+        return pd.DataFrame(dict(a=np.arange(n)))
+
+    @memoize(cache_dir=str(tmp_path))
+    def anything(n):
+        calls.append(1)
+        return dict(n=n, things=[1, "a"])
+
+    n_calls = len(calls)
+    assert frame(3).equals(frame(3)), "DataFrames not stored correctly"
+    assert anything(3) == anything(3), "objects not stored correctly"
+    assert len(calls) == n_calls + 2, "results were not reused"
+
+    # no temporary files should be left behind
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    clear_cache(str(tmp_path))
+    assert os.listdir(tmp_path) == [], "clear_cache did not clear cache"
+
+
+def test_memoize_parquet(tmp_path):
+    """DataFrames are stored as parquet, or pickled if parquet can't
+    store them"""
+
+    pytest.importorskip("pyarrow")
+
+    @memoize(cache_dir=str(tmp_path))
+    def frame(columns):
+        return pd.DataFrame({column: [1, "a"] for column in columns})
+
+    # object columns of mixed types can't be written as parquet
+    for columns in [["a"], [0]]:
+        result = frame(columns)
+        assert result.equals(frame(columns)), "DataFrame not stored correctly"
+
+    assert sorted(os.path.splitext(f)[1] for f in os.listdir(tmp_path)) == [
+        ".pkl",
+        ".pkl",
+    ]
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    @memoize(cache_dir=str(tmp_path))
+    def numbers(n):
+        return pd.DataFrame(dict(a=np.arange(n)))
+
+    assert numbers(3).equals(numbers(3))
+    assert any(f.endswith(".parquet") for f in os.listdir(tmp_path))
+
+
+def test_memoize_eviction(tmp_path):
+    """tests that least recently used results are evicted"""
+
+    @memoize(cache_dir=str(tmp_path), max_entries=2)
+    def f(x):
+        return np.full(10, x)
+
+    f(1)
+    f(2)
+    files = sorted(os.listdir(tmp_path))
+    for i, file in enumerate(files):
+        os.utime(os.path.join(tmp_path, file), ns=(i, i))
+
+    f(3)
+    assert len(os.listdir(tmp_path)) == 2, "results were not evicted"
+    assert files[0] not in os.listdir(tmp_path), "evicted the wrong result"
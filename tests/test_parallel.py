@@ -0,0 +1,223 @@
+"""
+This module tests functions in pycore.parallel
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from pycore.matlab import parfor, splitapply
+from pycore.parallel import (
+    chunk_edges,
+    configure_pool,
+    from_shared_memory,
+    get_pool,
+    pool_settings,
+    release_shared_memory,
+    shutdown_pool,
+    to_shared_memory,
+    worker_pool,
+)
+
+
+def test_to_shared_memory():
+    """tests allocating arrays in shared memory"""
+
+    x = np.random.rand(10, 3)
+    shm, arr, spec = to_shared_memory(x.shape, x.dtype, fill=x)
+    assert np.array_equal(arr, x), "array not copied to shared memory"
+    assert spec["shape"] == x.shape, "wrong shape in spec"
+    del arr
+    release_shared_memory(shm)
+
+    # zero-size arrays should work too
+    shm, arr, _ = to_shared_memory((0,), np.float64)
+    assert arr.shape == (0,), "wrong shape for empty array"
+    del arr
+    release_shared_memory(shm)
+
+
+def test_from_shared_memory():
+    """tests attaching to arrays in shared memory"""
+
+    shm, arr, spec = to_shared_memory((5,), np.int32, fill=3)
+
+    other_shm, other = from_shared_memory(spec)
+    assert np.array_equal(other, arr), "attached to the wrong array"
+
+    other[0] = -1
+    assert arr[0] == -1, "arrays don't share memory"
+
+    del other, arr
+    other_shm.close()
+    release_shared_memory(shm)
+
+
+def test_release_shared_memory():
+    """memory should be gone after it is released"""
+
+    shm, arr, spec = to_shared_memory((5,), np.int32)
+    del arr
+    release_shared_memory(shm)
+
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=spec["name"])
+
+
+def test_get_pool():
+    """the pool should be started once and then reused"""
+
+    shutdown_pool()
+    pool = get_pool()
+    assert get_pool() is pool, "pool was not reused"
+
+    x = np.random.rand(10, 6)
+    assert np.allclose(parfor(np.sum, (x,)), x.sum(axis=0))
+    assert get_pool() is pool, "parfor did not use the shared pool"
+
+    # asking for fewer processes shouldn't restart the pool
+    groups = np.repeat(np.arange(5), 2)
+    for _ in range(3):
+        parfor(np.sum, (x,))
+        splitapply(x, groups=groups, func=np.ptp, n_jobs=2)
+    assert get_pool() is pool, "splitapply restarted the pool"
+
+    shutdown_pool()
+
+
+# functions defined in __main__ after the pool was forked, like in a
+# notebook. This has to run in a fresh interpreter to have a __main__
+_NEW_FUNCTIONS_SCRIPT = """
+import numpy as np
+from pycore.matlab import parfor, splitapply
+from pycore.parallel import configure_pool
+
+configure_pool(n_workers=2, start_method="fork")
+x = np.arange(12.0).reshape(3, 4)
+
+def f(x):
+    return x.sum()
+
+assert np.allclose(parfor(f, (x,)), x.sum(axis=0))
+
+def g(x):
+    return x.max()
+
+assert np.allclose(parfor(g, (x,)), x.max(axis=0))
+
+def f(x):
+    return x.min()
+
+assert np.allclose(parfor(f, (x,)), x.min(axis=0)), "stale f was used"
+out = splitapply(x.T, groups=np.array([0, 0, 1, 1]), func=f, n_jobs=2)
+assert np.allclose(out, [0, 2])
+"""
+
+
+def test_get_pool_new_functions():
+    """functions defined after the pool started should still work"""
+
+    env = dict(os.environ)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = repo_dir + os.pathsep + env.get("PYTHONPATH", "")
+
+    subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", _NEW_FUNCTIONS_SCRIPT],
+        env=env,
+        check=True,
+        timeout=120,
+    )
+
+
+def test_configure_pool():
+    """changing options restarts the pool with those options"""
+
+    configure_pool(n_workers=2, start_method="spawn", chunk_size=3)
+    settings = pool_settings()
+    assert settings.n_workers == 2, "n_workers was not set"
+    assert settings.start_method == "spawn", "start_method was not set"
+    assert settings.chunk_size == 3, "chunk_size was not set"
+
+    x = np.random.rand(10, 7)
+    assert np.allclose(parfor(np.sum, (x,)), x.sum(axis=0))
+    assert np.allclose(
+        parfor(np.sum, (x,), shared_memory=False), x.sum(axis=0)
+    )
+
+    configure_pool()
+    assert pool_settings().chunk_size is None, "options were not reset"
+
+
+def test_chunk_edges():
+    """chunks follow the pool's chunk size, or its number of workers"""
+
+    configure_pool(chunk_size=3)
+    assert np.array_equal(chunk_edges(10), [0, 3, 6, 9, 10])
+    assert np.array_equal(chunk_edges(10, start=1), [1, 4, 7, 10])
+
+    configure_pool(n_workers=2)
+    edges = chunk_edges(100)
+    assert len(edges) == 2 * 4 + 1, "expected 4 chunks per worker"
+    assert edges[0] == 0 and edges[-1] == 100
+    assert len(chunk_edges(3)) == 4, "chunks should not be empty"
+
+    configure_pool()
+
+
+def test_pool_settings():
+    """settings should follow configure_pool and worker_pool"""
+
+    shutdown_pool()
+    configure_pool()
+    default = pool_settings()
+    assert default.n_workers == multiprocessing.cpu_count()
+    assert default.start_method == multiprocessing.get_start_method()
+    assert default.chunk_size is None, "chunk_size should default to None"
+
+    configure_pool(n_workers=2, chunk_size=5)
+    assert pool_settings().n_workers == 2, "configured n_workers ignored"
+    assert pool_settings().chunk_size == 5, "configured chunk_size ignored"
+
+    # a running pool reports what it was started with
+    get_pool()
+    assert pool_settings().n_workers == 2, "running pool has wrong settings"
+
+    with worker_pool(n_workers=1, start_method="spawn"):
+        inside = pool_settings()
+        assert inside.n_workers == 1, "worker_pool n_workers ignored"
+        assert inside.start_method == "spawn", "start_method ignored"
+        assert inside.chunk_size is None, "worker_pool has its own options"
+
+    assert pool_settings().n_workers == 2, "settings not restored"
+    assert pool_settings().chunk_size == 5, "settings not restored"
+
+    configure_pool()
+    assert pool_settings() == default, "configure_pool() should reset"
+
+
+def test_shutdown_pool():
+    """shutting down lets the next call start a new pool"""
+
+    pool = get_pool()
+    shutdown_pool()
+    assert get_pool() is not pool, "pool was not shut down"
+    shutdown_pool()
+
+
+def test_worker_pool():
+    """scoped pools are used inside the with block only"""
+
+    shared = get_pool()
+    with worker_pool(n_workers=1, chunk_size=2) as pool:
+        assert get_pool() is pool, "scoped pool not used"
+        assert pool_settings().n_workers == 1, "wrong settings"
+
+        x = np.random.rand(10, 5)
+        assert np.allclose(parfor(np.sum, (x,)), x.sum(axis=0))
+
+    assert get_pool() is shared, "shared pool not restored"
+    shutdown_pool()